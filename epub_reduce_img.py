@@ -0,0 +1,406 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Reduce images in epub files.
+
+PNG images are converted to 16 gray levels, JPEG images quality is set to 85;
+all are resized to max 800x1024 and optimized by pngout / leanify (when
+available). Other members are copied to new file without recompression.
+New file is written next to source as <name>_new.epub.
+Reduced images are cached (by content and reduction parameters), so the same
+images in other files are not processed again.
+"""
+
+from __future__ import print_function
+
+__author__ = 'Karol Będkowski'
+__copyright__ = 'Copyright (c) Karol Będkowski, 2017'
+__licence__ = "GPLv3"
+__version__ = "0.1"
+
+import os
+import sys
+import time
+import zlib
+import hashlib
+import tempfile
+import subprocess
+import zipfile
+from optparse import OptionParser
+
+from epubinfo import ZipReader, process_files_parallel
+
+
+CONVERT_OPTIONS = {
+    '.png': ['-colorspace', 'gray', '-colors', '16', '-depth', '4',
+             '-thumbnail', '800x1024', '-define', 'png:compression-level=9',
+             '-quality', '9'],
+    '.jpg': ['-thumbnail', '800x1024', '-quality', '85'],
+}
+CONVERT_OPTIONS['.jpeg'] = CONVERT_OPTIONS['.jpg']
+IMAGE_FORMATS = {'.png': 'png', '.jpg': 'jpg', '.jpeg': 'jpg'}
+PNGOUT_OPTIONS = ['-f5', '-y', '-q']
+LEANIFY_OPTIONS = ['-q', '-i', '5']
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or
+                         os.path.expanduser('~/.cache'), 'epub_reduce_img')
+CACHE_SIZE = 1024  # MB
+COPY_BUFFER = 1024 * 1024
+
+
+def _log(*args):
+    print('[%s]:' % time.strftime('%Y-%m-%d %H:%M:%S'), *args,
+          file=sys.stderr)
+
+
+def find_program(name):
+    """ Find `name` in PATH; return full path or None. """
+    if os.path.dirname(name):
+        return name if os.access(name, os.X_OK) else None
+    for dirname in os.environ.get('PATH', '').split(os.pathsep):
+        path = os.path.join(dirname, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+
+def _image_ext(name):
+    ext = os.path.splitext(name)[1].lower()
+    return ext if ext in IMAGE_FORMATS else None
+
+
+def _run_filter(args, data):
+    """ Run `args` with `data` on stdin; return stdout. """
+    proc = subprocess.Popen(args, stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate(data)
+    if proc.returncode:
+        raise OSError('%s failed: %s' % (args[0], err.strip()))
+    return out
+
+
+def _optimize_file(data, ext, tools):
+    """ Optimize image by tools working on files (pngout, leanify). """
+    commands = []
+    if ext == '.png' and tools.get('pngout'):
+        commands.append([tools['pngout']] + PNGOUT_OPTIONS)
+    if tools.get('leanify'):
+        commands.append([tools['leanify']] + LEANIFY_OPTIONS)
+    if not commands:
+        return data
+    with tempfile.NamedTemporaryFile(suffix=ext, delete=False) as tmpf:
+        tmpf.write(data)
+    try:
+        with open(os.devnull, 'wb') as devnull:
+            for command in commands:
+                # pngout return 2 when file can't be compressed better
+                subprocess.call(command + [tmpf.name], stdout=devnull,
+                                stderr=devnull)
+        with open(tmpf.name, 'rb') as ifile:
+            return ifile.read()
+    finally:
+        os.unlink(tmpf.name)
+
+
+class ImageCache(object):
+    """ Reduced images stored in directory by hash of source image and
+    reduction parameters. Files modification time is updated on use, so
+    least recently used are removed first when cache exceed `max_size`. """
+
+    def __init__(self, dirname, max_size):
+        self.dirname = dirname
+        self.max_size = max_size
+
+    @staticmethod
+    def key(ext, tools, data):
+        """ Get key for image `data` reduced by `tools`. """
+        params = [ext]
+        if tools.get('convert'):
+            params.append(CONVERT_OPTIONS[ext])
+        if ext == '.png' and tools.get('pngout'):
+            params.append(PNGOUT_OPTIONS)
+        if tools.get('leanify'):
+            params.append(LEANIFY_OPTIONS)
+        digest = hashlib.sha256(repr(params).encode('utf-8') + b'\0')
+        digest.update(data)
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.dirname, key[:2], key[2:])
+
+    def get(self, key):
+        """ Get reduced image; return None when not found. """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as ifile:
+                data = ifile.read()
+            os.utime(path, None)
+        except (IOError, OSError):
+            return None
+        return data
+
+    def put(self, key, data):
+        path = self._path(key)
+        tmpname = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(tmpname, 'wb') as ofile:
+                ofile.write(data)
+            os.rename(tmpname, path)
+        except (IOError, OSError) as err:
+            _log('Error writing cache %s: %s' % (path, err))
+
+    def prune(self):
+        """ Remove least recently used images to fit in max_size;
+        return number of removed files. """
+        entries = []
+        for dirpath, _dirs, files in os.walk(self.dirname):
+            for name in files:
+                path = os.path.join(dirpath, name)
+                try:
+                    fstat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((fstat.st_mtime, fstat.st_size, path))
+        total = sum(entry[1] for entry in entries)
+        removed = 0
+        for _mtime, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        return removed
+
+
+def reduce_image(args):
+    """ Reduce image; `args` is (member name, image data, tools, cache or
+    None); return (name, data, error, cached); on error data are not
+    changed. """
+    name, data, tools, cache = args
+    ext = _image_ext(name)
+    key = None
+    if cache:
+        key = cache.key(ext, tools, data)
+        cached = cache.get(key)
+        if cached is not None:
+            return name, cached, None, True
+    try:
+        if tools.get('convert'):
+            fmt = IMAGE_FORMATS[ext]
+            data = _run_filter([tools['convert'], fmt + ':-'] +
+                               CONVERT_OPTIONS[ext] + [fmt + ':-'], data)
+        data = _optimize_file(data, ext, tools)
+    except (OSError, IOError) as err:
+        return name, args[1], str(err), False
+    if cache:
+        cache.put(key, data)
+    return name, data, None, False
+
+
+def _dos_date_time(date_time):
+    year, month, day, hour, minute, second = date_time[:6]
+    return (((year - 1980) << 9 | month << 5 | day),
+            (hour << 11 | minute << 5 | second // 2))
+
+
+class ZipWriter(object):
+    """ Write zip file from already compressed members. """
+
+    def __init__(self, fileobj):
+        self._file = fileobj
+        self._offset = 0
+        self._entries = []
+
+    def _write(self, data):
+        self._file.write(data)
+        self._offset += len(data)
+
+    def add(self, info, method, crc, csize, size, chunks):
+        """ Write member described by ZipInfo `info`, compressed by `method`,
+        with compressed data from `chunks`. """
+        name = info.filename
+        flags = 0
+        if not isinstance(name, bytes):
+            try:
+                name = name.encode('ascii')
+            except UnicodeError:
+                name = name.encode('utf-8')
+                flags = 0x800
+        if self._offset > 0xffffffff or csize > 0xffffffff or \
+                size > 0xffffffff:
+            raise zipfile.LargeZipFile('zip64 is not supported')
+        dosdate, dostime = _dos_date_time(info.date_time)
+        entry = (flags, method, dostime, dosdate, crc, csize, size, name,
+                 self._offset, info.external_attr)
+        self._write(ZipReader.LOCAL.pack(
+            ZipReader.LOCAL_MAGIC, 20, 0, flags, method, dostime, dosdate,
+            crc, csize, size, len(name), 0))
+        self._write(name)
+        written = 0
+        for chunk in chunks:
+            self._write(chunk)
+            written += len(chunk)
+        if written != csize:
+            raise zipfile.BadZipfile('Wrong size of %r' % info.filename)
+        self._entries.append(entry)
+
+    def add_data(self, info, data, compress=True):
+        """ Write member `info` with (not compressed) `data`. """
+        if compress:
+            comp = zlib.compressobj(9, zlib.DEFLATED, -15)
+            cdata = comp.compress(data) + comp.flush()
+            method = zipfile.ZIP_DEFLATED
+        else:
+            cdata, method = data, zipfile.ZIP_STORED
+        self.add(info, method, zlib.crc32(data) & 0xffffffff, len(cdata),
+                 len(data), [cdata])
+
+    def close(self):
+        """ Write central directory. """
+        start = self._offset
+        for (flags, method, dostime, dosdate, crc, csize, size, name,
+             offset, external_attr) in self._entries:
+            self._write(ZipReader.CDIR.pack(
+                ZipReader.CDIR_MAGIC, 20, 3, 20, 0, flags, method, dostime,
+                dosdate, crc, csize, size, len(name), 0, 0, 0, 0,
+                external_attr, offset))
+            self._write(name)
+        self._write(ZipReader.EOCD.pack(
+            ZipReader.EOCD_MAGIC, 0, 0, len(self._entries),
+            len(self._entries), self._offset - start, start, 0))
+
+
+def _raw_chunks(srcfile, info):
+    """ Read compressed data of member `info` from `srcfile`. """
+    srcfile.seek(info.header_offset)
+    header = srcfile.read(ZipReader.LOCAL.size)
+    fields = ZipReader.LOCAL.unpack(header)
+    if fields[0] != ZipReader.LOCAL_MAGIC:
+        raise zipfile.BadZipfile("Bad magic number for file header")
+    srcfile.seek(fields[10] + fields[11], os.SEEK_CUR)
+    left = info.compress_size
+    while left > 0:
+        chunk = srcfile.read(min(left, COPY_BUFFER))
+        if not chunk:
+            raise zipfile.BadZipfile("Truncated file %r" % info.filename)
+        left -= len(chunk)
+        yield chunk
+
+
+def _copy_member(writer, srcfile, info):
+    writer.add(info, info.compress_type, info.CRC, info.compress_size,
+               info.file_size, _raw_chunks(srcfile, info))
+
+
+def _member_order(info):
+    if info.filename == 'mimetype':
+        return 0
+    if info.filename.startswith('META-INF/'):
+        return 1
+    return 2
+
+
+def reduce_epub(src, dst, tools, jobs=None, cache=None):
+    """ Write `src` epub to `dst` with reduced images.
+
+    `tools` is dict with paths to convert, pngout and leanify (None - skip).
+    `cache` is optional ImageCache.
+    Return (source images size, reduced images size, images from cache).
+    """
+    stats = [0, 0, 0]
+    with zipfile.ZipFile(src) as zin, open(src, 'rb') as srcfile, \
+            open(dst, 'wb') as dstfile:
+        writer = ZipWriter(dstfile)
+        infos = sorted(zin.infolist(), key=_member_order)
+        images = []
+        for info in infos:
+            if info.filename == 'mimetype' and \
+                    info.compress_type != zipfile.ZIP_STORED:
+                writer.add_data(info, zin.read(info), False)
+            elif _image_ext(info.filename) and not info.flag_bits & 0x1:
+                images.append(info)
+            else:
+                _copy_member(writer, srcfile, info)
+
+        def image_jobs():
+            for info in images:
+                yield info.filename, zin.read(info), tools, cache
+
+        infos = dict((info.filename, info) for info in images)
+        results = process_files_parallel(image_jobs(), jobs, reduce_image) \
+            if images else []
+        for name, data, error, cached in results:
+            if error:
+                _log('Error reducing %s: %s' % (name, error))
+            info = infos[name]
+            stats[0] += info.file_size
+            stats[1] += len(data)
+            stats[2] += cached
+            # images are already compressed
+            writer.add_data(info, data, False)
+        writer.close()
+    return stats
+
+
+def main():
+    parser = OptionParser(usage="%prog [options] file.epub ...",
+                          version="%prog " + __version__,
+                          description=__doc__)
+    parser.add_option("-o", "--output", dest="output",
+                      help="output file (only for one input file)")
+    parser.add_option("-j", "--jobs", type="int", dest="jobs", default=None,
+                      help="number of worker processes "
+                      "(default: number of CPUs)")
+    parser.add_option("--convert", dest="convert", default="convert",
+                      help="ImageMagick convert program (default %default)")
+    parser.add_option("--pngout", dest="pngout", default="pngout",
+                      help="pngout program (default %default)")
+    parser.add_option("--leanify", dest="leanify", default="leanify",
+                      help="leanify program (default %default)")
+    parser.add_option("--cache-dir", dest="cache_dir", default=CACHE_DIR,
+                      help="directory for reduced images cache "
+                      "(default %default)")
+    parser.add_option("--cache-size", type="int", dest="cache_size",
+                      default=CACHE_SIZE,
+                      help="max size of cache in MB (default %default)")
+    parser.add_option("--no-cache", action="store_false", dest="use_cache",
+                      default=True, help="don't use reduced images cache")
+    (options, args) = parser.parse_args()
+    if not args:
+        parser.error('missing files to process')
+    if options.output and len(args) > 1:
+        parser.error('--output require one input file')
+
+    tools = {}
+    for tool in ('convert', 'pngout', 'leanify'):
+        tools[tool] = find_program(getattr(options, tool))
+        if not tools[tool]:
+            _log('Warning: %s not found; skipping' % getattr(options, tool))
+
+    cache = ImageCache(options.cache_dir, options.cache_size * 1024 * 1024) \
+        if options.use_cache else None
+
+    for fname in args:
+        dst = options.output or os.path.splitext(fname)[0] + '_new.epub'
+        _log('New file:', dst)
+        try:
+            orig, reduced, cached = reduce_epub(fname, dst + '.tmp', tools,
+                                                options.jobs, cache)
+        except (zipfile.BadZipfile, zipfile.LargeZipFile, IOError) as err:
+            _log('Error processing %s: %s' % (fname, err))
+            if os.path.exists(dst + '.tmp'):
+                os.unlink(dst + '.tmp')
+            continue
+        os.rename(dst + '.tmp', dst)
+        _log('Images: %d -> %d bytes (%d from cache)' % (orig, reduced,
+                                                         cached))
+    if cache:
+        cache.prune()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+import epub_reduce_img as eri
+import epubinfo_tests
+
+
+FAKE_CONVERT = """#!/bin/sh
+echo run >> "$0.log"
+cat
+echo converted
+"""
+
+
+class TestReduceEpub(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.src = epubinfo_tests.create_epub(
+            os.path.join(self.tmpdir, 'book.epub'))
+        self.image = os.urandom(3000)
+        with zipfile.ZipFile(self.src, 'a') as zipf:
+            zipf.writestr('OEBPS/img.png', self.image, zipfile.ZIP_DEFLATED)
+            zipf.writestr(u'OEBPS/zdjęcie.JPG', self.image)
+            zipf.writestr('OEBPS/style.css', b'p {}\n' * 100,
+                          zipfile.ZIP_DEFLATED)
+        self.dst = os.path.join(self.tmpdir, 'book_new.epub')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _check_structure(self):
+        with zipfile.ZipFile(self.src) as src, \
+                zipfile.ZipFile(self.dst) as dst:
+            self.assertIsNone(dst.testzip())
+            infos = dst.infolist()
+            self.assertEqual(infos[0].filename, 'mimetype')
+            self.assertEqual(infos[0].compress_type, zipfile.ZIP_STORED)
+            self.assertEqual(infos[1].filename, 'META-INF/container.xml')
+            self.assertEqual(sorted(dst.namelist()), sorted(src.namelist()))
+            for info in src.infolist():
+                if not eri._image_ext(info.filename):
+                    dinfo = dst.getinfo(info.filename)
+                    self.assertEqual(dinfo.compress_size, info.compress_size)
+                    self.assertEqual(dst.read(dinfo), src.read(info))
+            return dst.read('OEBPS/img.png'), dst.read(u'OEBPS/zdjęcie.JPG')
+
+    def test_without_tools(self):
+        stats = eri.reduce_epub(self.src, self.dst, {}, 2)
+        self.assertEqual(stats, [6000, 6000, 0])
+        self.assertEqual(self._check_structure(), (self.image, self.image))
+
+    def _fake_convert(self):
+        convert = os.path.join(self.tmpdir, 'convert')
+        with open(convert, 'w') as ofile:
+            ofile.write(FAKE_CONVERT)
+        os.chmod(convert, 0o755)
+        return convert
+
+    def _convert_runs(self):
+        with open(os.path.join(self.tmpdir, 'convert.log')) as logfile:
+            return len(logfile.readlines())
+
+    def test_convert(self):
+        eri.reduce_epub(self.src, self.dst, {'convert': self._fake_convert()},
+                        2)
+        expected = self.image + b'converted\n'
+        self.assertEqual(self._check_structure(), (expected, expected))
+
+    def test_convert_error(self):
+        name, data, error, cached = eri.reduce_image(
+            ('img.png', self.image, {'convert': '/bin/false'}, None))
+        self.assertEqual(data, self.image)
+        self.assertTrue(error)
+
+    def test_cache(self):
+        cache = eri.ImageCache(os.path.join(self.tmpdir, 'cache'), 1000000)
+        tools = {'convert': self._fake_convert()}
+        stats = eri.reduce_epub(self.src, self.dst, tools, 2, cache)
+        self.assertEqual(stats[2], 0)
+        self.assertEqual(self._convert_runs(), 2)
+        stats = eri.reduce_epub(self.src, self.dst, tools, 2, cache)
+        self.assertEqual(stats[2], 2)
+        self.assertEqual(self._convert_runs(), 2)
+        expected = self.image + b'converted\n'
+        self.assertEqual(self._check_structure(), (expected, expected))
+        # other parameters - other key
+        self.assertNotEqual(eri.ImageCache.key('.png', tools, self.image),
+                            eri.ImageCache.key('.png', {}, self.image))
+
+
+class TestImageCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_prune(self):
+        cache = eri.ImageCache(self.tmpdir, 2500)
+        keys = [eri.ImageCache.key('.jpg', {}, b'%d' % idx)
+                for idx in range(3)]
+        for idx, key in enumerate(keys):
+            cache.put(key, b'x' * 1000)
+            os.utime(cache._path(key), (idx * 100, idx * 100))
+        self.assertEqual(cache.get(keys[0]), b'x' * 1000)  # touch
+        self.assertEqual(cache.prune(), 1)
+        self.assertIsNone(cache.get(keys[1]))
+        self.assertIsNotNone(cache.get(keys[0]))
+        self.assertIsNotNone(cache.get(keys[2]))
+
+
+if __name__ == '__main__':
+    unittest.main()
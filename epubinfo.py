@@ -5,8 +5,20 @@
 EPUB info
 
 Display information about epub file.
+In batch mode (--json) books are processed in parallel and for each book
+one JSON record is printed.
+With --cache metadata is stored in SQLite database and only new or changed
+books are parsed.
+Books in database can be searched by "query" command; query terms have form
+[field:]word[*], where field is one of: title, creator, subject, identifier,
+language, date; "*" match words by prefix.
+With --duplicates books with the same ISBN/UUID or title and authors are
+reported when their text is similar.
+With --stats size of content by media type, images and number of words are
+reported.
 
 """
+from __future__ import print_function
 
 __author__ = "Karol Będkowski"
 __copyright__ = "Copyright (c) Karol Będkowski, 2014"
@@ -17,21 +29,40 @@ VERSION = "0.1"
 
 
 import os
+import sys
+import json
 import optparse
 import zipfile
 import xml.etree.ElementTree as et
 import itertools
 import operator
+import threading
+import multiprocessing
+import sqlite3
+import struct
+import zlib
+import re
+import codecs
+import heapq
+import posixpath
+import collections
+import mimetypes
 
+try:
+    from html.parser import HTMLParser
+    from urllib.parse import unquote
+except ImportError:  # python2
+    from HTMLParser import HTMLParser
+    from urllib import unquote
 
-def check_file(filename):
+
+def file_error(filename):
+    """ Check is file readable; return error message or None. """
     if not os.path.isfile(filename):
-        print 'ERROR: its not a regular file'
-        return False
+        return 'its not a regular file'
     if not os.access(filename, os.R_OK):
-        print 'ERROR: file is not readable'
-        return False
-    return True
+        return 'file is not readable'
+    return None
 
 
 CONTAINER_XML = 'META-INF/container.xml'
@@ -42,7 +73,7 @@ ROOTFILE_TAG = "{urn:oasis:names:tc:opendocument:xmlns:container}rootfile"
 def get_content_opf_path(containter_xml):
     containter = et.fromstring(containter_xml)
     rootfiles = containter.find(ROOTFILES_TAG)
-    if len(rootfiles) == 0:
+    if rootfiles is None or len(rootfiles) == 0:
         raise KeyError("rootfiles not found in container.xml")
     rootfile = rootfiles.find(ROOTFILE_TAG)
     if rootfile is None:
@@ -50,21 +81,10 @@ def get_content_opf_path(containter_xml):
     return rootfile.attrib["full-path"]
 
 
-def get_opf(epub):
-    """ Load content.opf file from epub. """
-    try:
-        with zipfile.ZipFile(epub, "r") as zipf:
-            with zipf.open(CONTAINER_XML) as contf:
-                content_filename = get_content_opf_path(contf.read())
-            with zipf.open(content_filename, "r") as contentf:
-                return contentf.read()
-    except zipfile.BadZipfile, err:
-        print 'ERROR: Wrong file - %s ' % err
-    except KeyError, err:
-        print 'ERROR: Wrong file - %s' % err
-    except IOError, err:
-        print 'ERROR: %s' % err
-    return None
+def _error_message(err):
+    if isinstance(err, (zipfile.BadZipfile, KeyError)):
+        return 'Wrong file - %s' % err
+    return str(err)
 
 
 OPF_NS = '{http://www.idpf.org/2007/opf}'
@@ -103,7 +123,7 @@ def process_opf(opf):
     if len(package) == 0:
         return
     manifest = package.find(MANIFEST_TAG)
-    if len(manifest) == 0:
+    if manifest is None or len(manifest) == 0:
         return
     for tag in manifest:
         if tag.tag.startswith(OPF_NS):
@@ -113,6 +133,248 @@ def process_opf(opf):
             yield process_purl_tag(tag)
 
 
+def iter_opf(opffile):
+    """ Get tags from content opf file-like object.
+
+    Like process_opf but parse file incrementally and stop reading after
+    metadata element.
+    """
+    depth = 0
+    in_metadata = False
+    for event, elem in et.iterparse(opffile, events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            if depth == 2 and elem.tag == MANIFEST_TAG:
+                in_metadata = True
+            continue
+        depth -= 1
+        if not in_metadata:
+            continue
+        if depth == 1:
+            # end of metadata
+            break
+        if depth == 2:
+            if elem.tag.startswith(OPF_NS):
+                if 'name' in elem.attrib:
+                    yield process_opf_tag(elem)
+            elif elem.tag.startswith(PURL_NS):
+                yield process_purl_tag(elem)
+            elem.clear()
+
+
+if hasattr(os, 'pread'):
+    _pread = os.pread
+else:
+    def _pread(fd, size, offset):
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.read(fd, size)
+
+
+class _Unsupported(Exception):
+    """ Archive can't be read by ZipReader; use zipfile. """
+    pass
+
+
+class ZipReader(object):
+    """ Minimal zip reader.
+
+    Read end of central directory and central directory by one or two reads;
+    members are read on demand in large chunks. Only not encrypted, stored
+    and deflated members without zip64 extensions are supported (otherwise
+    _Unsupported is raised). _Unsupported is raised also for inconsistent
+    structure of archive, so zipfile decides if it is valid.
+    """
+
+    TAIL_SIZE = 16 * 1024
+    READ_SIZE = 64 * 1024
+    EOCD = struct.Struct('<4s4H2LH')
+    EOCD_MAGIC = b'PK\005\006'
+    # zip64 end of central directory locator (right before EOCD)
+    ZIP64_LOCATOR_SIZE = 20
+    ZIP64_LOCATOR_MAGIC = b'PK\006\007'
+    CDIR = struct.Struct('<4s4B4HL2L5H2L')
+    CDIR_MAGIC = b'PK\001\002'
+    LOCAL = struct.Struct('<4s2B4HL2L2H')
+    LOCAL_MAGIC = b'PK\003\004'
+
+    def __init__(self, filename):
+        self._fd = os.open(filename, os.O_RDONLY)
+        try:
+            self.members = self._read_directory()
+        except Exception:
+            self.close()
+            raise
+
+    def _read_directory(self):
+        """ Load central directory; return {name: (flags, method, crc,
+        compressed size, size, header offset, header size)}. """
+        size = os.fstat(self._fd).st_size
+        tail_start = max(0, size - self.TAIL_SIZE)
+        tail = _pread(self._fd, size - tail_start, tail_start)
+        pos = tail.rfind(self.EOCD_MAGIC)
+        if pos < 0 or len(tail) - pos < self.EOCD.size:
+            # not a zip or long comment
+            raise _Unsupported()
+        (_magic, disk, cdir_disk, _disk_entries, entries, cdir_size,
+         cdir_offset, _comment_len) = self.EOCD.unpack_from(tail, pos)
+        locator = pos - self.ZIP64_LOCATOR_SIZE
+        if disk or cdir_disk or entries == 0xffff or \
+                cdir_offset == 0xffffffff or (locator >= 0 and tail[
+                    locator:locator + 4] == self.ZIP64_LOCATOR_MAGIC):
+            raise _Unsupported()
+        cdir_start = tail_start + pos - cdir_size
+        if cdir_start < 0:
+            # bad offset for central directory
+            raise _Unsupported()
+        if cdir_start >= tail_start:
+            cdir = tail[cdir_start - tail_start:pos]
+        else:
+            # read only missing part of directory
+            cdir = _pread(self._fd, tail_start - cdir_start, cdir_start) + \
+                tail[:pos]
+        # data prepended to archive
+        concat = cdir_start - cdir_offset
+        members = {}
+        offset = 0
+        for _idx in range(entries):
+            if len(cdir) - offset < self.CDIR.size:
+                # truncated central directory
+                raise _Unsupported()
+            fields = self.CDIR.unpack_from(cdir, offset)
+            if fields[0] != self.CDIR_MAGIC:
+                # bad magic number for central directory
+                raise _Unsupported()
+            flags, method, crc, csize, usize = fields[5:7] + fields[9:12]
+            name_len, extra_len, comment_len = fields[12:15]
+            if csize == 0xffffffff or usize == 0xffffffff or \
+                    fields[18] == 0xffffffff:
+                raise _Unsupported()
+            name = cdir[offset + self.CDIR.size:
+                        offset + self.CDIR.size + name_len]
+            name = name.decode('utf-8' if flags & 0x800 else 'cp437')
+            # local header usually has the same name and extra fields
+            members[name] = (flags, method, crc, csize, usize,
+                             fields[18] + concat,
+                             self.LOCAL.size + name_len + extra_len)
+            offset += self.CDIR.size + name_len + extra_len + comment_len
+        return members
+
+    def open(self, name):
+        """ Open member `name` for reading. """
+        try:
+            flags, method, crc, csize, _usize, offset, header_size = \
+                self.members[name]
+        except KeyError:
+            raise KeyError('There is no item named %r in the archive' % name)
+        if flags & 0x1 or method not in (zipfile.ZIP_STORED,
+                                         zipfile.ZIP_DEFLATED):
+            raise _Unsupported()
+        # read local header and first part of data at once
+        chunk = _pread(self._fd, header_size + min(csize, self.READ_SIZE),
+                       offset)
+        if len(chunk) < self.LOCAL.size:
+            # truncated file header
+            raise _Unsupported()
+        fields = self.LOCAL.unpack_from(chunk)
+        if fields[0] != self.LOCAL_MAGIC:
+            # bad magic number for file header
+            raise _Unsupported()
+        start = self.LOCAL.size + fields[10] + fields[11]
+        chunk = chunk[start:start + csize]
+        return _MemberReader(self._fd, name, chunk,
+                             offset + start + len(chunk), csize - len(chunk),
+                             method, crc, self.READ_SIZE)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_args):
+        self.close()
+
+
+class _MemberReader(object):
+    """ File-like object for reading (and decompressing) zip member. """
+
+    def __init__(self, fdesc, name, chunk, offset, left, method, crc,
+                 read_size):
+        self._fd = fdesc
+        self._name = name
+        self._pending = chunk
+        self._offset = offset
+        self._left = left
+        self._crc = crc
+        self._read_size = read_size
+        self._decomp = zlib.decompressobj(-15) \
+            if method == zipfile.ZIP_DEFLATED else None
+        self._running_crc = 0
+        self._buf = b''
+        self._eof = False
+
+    def _fill(self):
+        if not self._pending and self._left > 0:
+            self._pending = _pread(self._fd, min(self._left, self._read_size),
+                                   self._offset)
+            if not self._pending:
+                raise zipfile.BadZipfile("Truncated file %r" % self._name)
+            self._offset += len(self._pending)
+            self._left -= len(self._pending)
+        if self._decomp is None:
+            data, self._pending = self._pending, b''
+        else:
+            data = self._decomp.decompress(self._pending,
+                                           self._read_size * 4)
+            self._pending = self._decomp.unconsumed_tail
+            if not self._pending and self._left <= 0:
+                data += self._decomp.flush()
+        self._running_crc = zlib.crc32(data, self._running_crc)
+        self._buf += data
+        if not self._pending and self._left <= 0:
+            self._eof = True
+            if self._running_crc & 0xffffffff != self._crc:
+                raise zipfile.BadZipfile("Bad CRC-32 for file %r" %
+                                         self._name)
+
+    def read(self, size=-1):
+        while not self._eof and (size < 0 or len(self._buf) < size):
+            self._fill()
+        if size < 0:
+            data, self._buf = self._buf, b''
+        else:
+            data, self._buf = self._buf[:size], self._buf[size:]
+        return data
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_args):
+        self.close()
+
+
+def _opf_tags(zipf):
+    with zipf.open(CONTAINER_XML) as contf:
+        content_filename = get_content_opf_path(contf.read())
+    with zipf.open(content_filename) as contentf:
+        return list(iter_opf(contentf))
+
+
+def load_opf_tags(epub):
+    """ Get tags from epub; raise exception on errors. """
+    try:
+        with ZipReader(epub) as zipf:
+            return _opf_tags(zipf)
+    except _Unsupported:
+        with zipfile.ZipFile(epub, "r") as zipf:
+            return _opf_tags(zipf)
+
+
 def get_full_filename(fname):
     """ Expand file path. """
     fname = os.path.expanduser(fname)
@@ -120,9 +382,14 @@ def get_full_filename(fname):
     return fname
 
 
+def _element_key(elem):
+    tag, subtag, content, _attrs = elem
+    return (tag, subtag or '', content or '')
+
+
 def group_tags(elements):
     """ Group elements into groups by tag """
-    elements = sorted(elements)
+    elements = sorted(elements, key=_element_key)
     groups = {key: list(group) for key, group
               in itertools.groupby(elements, key=operator.itemgetter(0))}
     return groups
@@ -149,27 +416,694 @@ def sort_group_names(groups):
     return sorted(groups, key=key_func)
 
 
+if bytes is str:  # python2
+    def _to_str(value):
+        return value.encode('utf-8', 'ignore')
+else:
+    def _to_str(value):
+        return value
+
+
 def show(groups):
     """ Display data."""
-    for group_name in sort_group_names(groups.iterkeys()):
+    for group_name in sort_group_names(groups.keys()):
         group = groups[group_name]
-        print '%-10s' % group_name.capitalize()
+        print('%-10s' % group_name.capitalize())
         for _group, lev2, value, attrs in group:
-            value = value.encode('utf-8', errors='ignore') if value else ''
-            print "\t%-10s\t%s" % (lev2 or '', value),
+            value = _to_str(value) if value else ''
+            line = "\t%-10s\t%s" % (lev2 or '', value)
             if attrs:
-                print '\t',
-                print ';'.join(key + '=' + val.encode('utf-8', errors='ignore')
-                               for key, val in attrs.iteritems()),
-            print
-        print
+                line += ' \t ' + ';'.join(key + '=' + _to_str(val)
+                                          for key, val in attrs.items())
+            print(line)
+        print()
+
+
+def process_file(fname):
+    """ Get tags from epub; return record for batch mode:
+    {"path": fname, "tags": groups, "error": error message or None}.
+    """
+    record = {'path': fname, 'tags': None, 'error': file_error(fname)}
+    if record['error']:
+        return record
+    try:
+        record['tags'] = group_tags(load_opf_tags(fname))
+    except Exception as err:  # pylint: disable=broad-except
+        # any problem with one book must not break batch
+        record['error'] = _error_message(err)
+    return record
+
+
+def find_files(args, recursive):
+    """ Get files from `args`; when `recursive` find epubs in directories.
+    """
+    for arg in args:
+        fname = get_full_filename(arg)
+        if recursive and os.path.isdir(fname):
+            for root, dirs, files in os.walk(fname):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.lower().endswith('.epub'):
+                        yield os.path.join(root, name)
+        else:
+            yield fname
+
+
+def _bounded(items, semaphore, stop):
+    """ Yield `items`; wait on `semaphore` before each one; finish when
+    `stop` is set. """
+    for item in items:
+        semaphore.acquire()
+        if stop.is_set():
+            return
+        yield item
+
+
+def process_files_parallel(fnames, jobs=None, func=process_file):
+    """ Process `fnames` by `func` in process pool.
+
+    Yield results in order of completion. Only few files are queued at once,
+    so memory usage not depend on number of files.
+    """
+    jobs = jobs or multiprocessing.cpu_count()
+    semaphore = threading.Semaphore(jobs * 4)
+    stop = threading.Event()
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for result in pool.imap_unordered(func, _bounded(fnames, semaphore,
+                                                         stop)):
+            semaphore.release()
+            yield result
+        pool.close()
+    finally:
+        # wake up task feeder waiting in _bounded; otherwise terminate
+        # hangs when consumer breaks on error
+        stop.set()
+        semaphore.release()
+        pool.terminate()
+        pool.join()
+
+
+def show_json(record):
+    """ Print one NDJSON record. """
+    print(json.dumps(record, sort_keys=True))
+    sys.stdout.flush()
+
+
+if bytes is str:  # python2
+    def _path_key(path):
+        return sqlite3.Binary(path)
+
+    def _path_from_key(key):
+        return str(key)
+
+    def _to_unicode(value):
+        return value.decode('utf-8', 'replace')
+
+    _chr = unichr  # noqa
+else:
+    def _path_key(path):
+        return os.fsencode(path)
+
+    def _path_from_key(key):
+        return os.fsdecode(key)
+
+    def _to_unicode(value):
+        return value
+
+    _chr = chr
+
+
+INDEXED_FIELDS = ('title', 'creator', 'subject', 'identifier', 'language',
+                  'date')
+_WORDS_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def _words(text):
+    return _WORDS_RE.findall(text.lower())
+
+
+def index_terms(tags):
+    """ Get set of (field, word) for indexed fields in `tags`. """
+    terms = set()
+    for field in INDEXED_FIELDS:
+        for _tag, _subtag, value, _attrs in tags.get(field, ()):
+            if value:
+                terms.update((field, word) for word in _words(value))
+    return terms
+
+
+def parse_query(args):
+    """ Parse query terms `[field:]word[*]`; return list of conditions
+    (field or None, word, is prefix). """
+    conditions = []
+    for arg in args:
+        field, text = None, _to_unicode(arg)
+        if ':' in text:
+            field, text = text.split(':', 1)
+            field = field.lower()
+            if field not in INDEXED_FIELDS:
+                raise ValueError('unknown field: %s' % field)
+        words = _words(text)
+        if not words:
+            continue
+        conditions.extend((field, word, False) for word in words[:-1])
+        conditions.append((field, words[-1], text.endswith('*')))
+    return conditions
+
+
+class MetadataCache(object):
+    """ SQLite database with results of process_file keyed by path, size
+    and mtime. """
+
+    COMMIT_INTERVAL = 500
+
+    def __init__(self, filename):
+        self._conn = sqlite3.connect(filename)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS books (path BLOB PRIMARY KEY, "
+            "size INTEGER, mtime REAL, tags TEXT, error TEXT)")
+        new_index = self._conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name='terms'").fetchone() \
+            is None
+        # inverted index: words from INDEXED_FIELDS -> books rowid
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS terms (field TEXT, term TEXT, "
+            "book INTEGER)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS terms_term ON terms "
+                           "(term, field, book)")
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS terms_book ON terms (book)")
+        self._changes = 0
+        if new_index:
+            self._index_books()
+
+    def _index_books(self):
+        """ Index books stored before index was created. """
+        rows = self._conn.execute(
+            "SELECT rowid, tags FROM books WHERE tags IS NOT NULL")
+        for book, tags in rows.fetchall():
+            self._index(book, json.loads(tags))
+
+    def _index(self, book, tags):
+        self._conn.executemany(
+            "INSERT INTO terms VALUES (?, ?, ?)",
+            [(field, term, book) for field, term in index_terms(tags)])
+
+    def _unindex(self, keys):
+        self._conn.executemany(
+            "DELETE FROM terms WHERE book IN "
+            "(SELECT rowid FROM books WHERE path=?)", keys)
+
+    def get(self, path, size, mtime):
+        """ Get record for `path`; return None when file changed. """
+        row = self._conn.execute(
+            "SELECT tags, error FROM books WHERE path=? AND size=? AND "
+            "mtime=?", (_path_key(path), size, mtime)).fetchone()
+        if row is None:
+            return None
+        tags = json.loads(row[0]) if row[0] else None
+        return {'path': path, 'tags': tags, 'error': row[1]}
+
+    def put(self, record, size, mtime):
+        key = _path_key(record['path'])
+        self._unindex([(key, )])
+        cur = self._conn.execute(
+            "INSERT OR REPLACE INTO books VALUES (?, ?, ?, ?, ?)",
+            (key, size, mtime,
+             json.dumps(record['tags']) if record['tags'] else None,
+             record['error']))
+        if record['tags']:
+            self._index(cur.lastrowid, record['tags'])
+        self._modified()
+
+    def delete(self, path):
+        key = _path_key(path)
+        self._unindex([(key, )])
+        self._conn.execute("DELETE FROM books WHERE path=?", (key, ))
+        self._modified()
+
+    def prune(self, root, seen):
+        """ Delete entries for files in `root` that are not in `seen`
+        (set of _path_key). """
+        start = bytes(_path_key(os.path.join(root, '')))
+        # '0' follows '/'; select all paths with `start` prefix
+        end = start[:-1] + b'0'
+        rows = self._conn.execute(
+            "SELECT path FROM books WHERE path >= ? AND path < ?",
+            (sqlite3.Binary(start), sqlite3.Binary(end))).fetchall()
+        deleted = [row for row in rows if bytes(row[0]) not in seen]
+        self._unindex(deleted)
+        self._conn.executemany("DELETE FROM books WHERE path=?", deleted)
+        self._modified(len(deleted))
+        return len(deleted)
+
+    def query(self, conditions):
+        """ Find books matching all `conditions` (see parse_query);
+        return records sorted by path. """
+        subqueries, params = [], []
+        for field, word, prefix in conditions:
+            if prefix:
+                sql = "SELECT book FROM terms WHERE term >= ? AND term < ?"
+                params.extend((word, word[:-1] + _chr(ord(word[-1]) + 1)))
+            else:
+                sql = "SELECT book FROM terms WHERE term = ?"
+                params.append(word)
+            if field:
+                sql += " AND field = ?"
+                params.append(field)
+            subqueries.append(sql)
+        if not subqueries:
+            return []
+        rows = self._conn.execute(
+            "SELECT path, tags FROM books WHERE rowid IN (%s) ORDER BY path"
+            % " INTERSECT ".join(subqueries), params)
+        return [{'path': _path_from_key(path), 'tags': json.loads(tags),
+                 'error': None} for path, tags in rows]
+
+    def _modified(self, count=1):
+        self._changes += count
+        if self._changes >= self.COMMIT_INTERVAL:
+            self._conn.commit()
+            self._changes = 0
+
+    def close(self):
+        self._conn.commit()
+        self._conn.close()
+
+
+def process_files_cached(fnames, cache, jobs=None, roots=()):
+    """ Get records for `fnames`; parse (in parallel) only files not found in
+    `cache`. Remove from cache missing files and not found files in `roots`
+    directories. """
+    changed = {}
+    seen = set()
+    for fname in fnames:
+        error = file_error(fname)
+        if error:
+            cache.delete(fname)
+            yield {'path': fname, 'tags': None, 'error': error}
+            continue
+        seen.add(bytes(_path_key(fname)))
+        fstat = os.stat(fname)
+        record = cache.get(fname, fstat.st_size, fstat.st_mtime)
+        if record is None:
+            changed[fname] = (fstat.st_size, fstat.st_mtime)
+        else:
+            yield record
+    if changed:
+        for record in process_files_parallel(sorted(changed), jobs):
+            cache.put(record, *changed[record['path']])
+            yield record
+    for root in roots:
+        cache.prune(root, seen)
+
+
+ITEM_TAG = OPF_NS + 'item'
+ITEMREF_TAG = OPF_NS + 'itemref'
+SHINGLE_SIZE = 5
+SKETCH_SIZE = 128
+DUPLICATE_SIMILARITY = 0.5
+# only books sharing one of DUPLICATE_BANDS smallest sketch hashes are
+# compared; books with similarity 0.5 share one with probability > 0.99
+DUPLICATE_BANDS = 8
+_UUID_RE = re.compile(r'[0-9a-f]{8}(-[0-9a-f]{4}){3}-[0-9a-f]{12}$')
+_ISBN_RE = re.compile(r'(97[89])?\d{9}[\dx]$')
+
+
+def _isbn13(isbn):
+    """ Convert ISBN-10 to ISBN-13. """
+    if len(isbn) == 13:
+        return isbn
+    isbn = '978' + isbn[:9]
+    check = sum(int(digit) * (3 if idx % 2 else 1)
+                for idx, digit in enumerate(isbn))
+    return isbn + str((10 - check % 10) % 10)
+
+
+def book_keys(tags):
+    """ Get normalized keys identifying book: ('isbn', isbn13),
+    ('uuid', uuid) and ('title', title and authors words). """
+    keys = set()
+    for _tag, scheme, value, _attrs in tags.get('identifier', ()):
+        if not value:
+            continue
+        value = value.strip().lower()
+        for prefix in ('urn:uuid:', 'urn:isbn:', 'isbn:', 'uuid:'):
+            if value.startswith(prefix):
+                value = value[len(prefix):]
+        isbn = value.replace('-', '').replace(' ', '')
+        if _UUID_RE.match(value):
+            keys.add(('uuid', value))
+        elif (scheme or 'isbn').lower() == 'isbn' and _ISBN_RE.match(isbn):
+            keys.add(('isbn', _isbn13(isbn)))
+    titles = [value for _tag, _sub, value, _attrs in tags.get('title', ())
+              if value]
+    if titles:
+        authors = sorted(' '.join(_words(value)) for _tag, role, value, _attrs
+                         in tags.get('creator', ())
+                         if value and role in (None, 'aut'))
+        keys.add(('title', ' '.join(_words(titles[0])) + '|' +
+                  ';'.join(authors)))
+    return keys
+
+
+def read_manifest(opffile):
+    """ Get manifest items {id: (href, media type)} and spine (list of ids)
+    from content opf file-like object. """
+    items = {}
+    spine = []
+    for _event, elem in et.iterparse(opffile):
+        if elem.tag == ITEM_TAG:
+            items[elem.attrib.get('id')] = (elem.attrib.get('href'),
+                                            elem.attrib.get('media-type'))
+        elif elem.tag == ITEMREF_TAG:
+            spine.append(elem.attrib.get('idref'))
+        elem.clear()
+    return items, spine
+
+
+def spine_documents(items, spine):
+    """ Get hrefs of documents from spine (see read_manifest). """
+    return [items[idref][0] for idref in spine
+            if idref in items and items[idref][0]]
+
+
+def _member_name(base, href):
+    """ Get zip member name for `href` relative to opf file directory. """
+    return posixpath.normpath(posixpath.join(base, unquote(href)))
+
+
+class _TextParser(HTMLParser):
+    """ Get words from (x)html text; skip scripts and styles. """
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self._skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ('script', 'style'):
+            self._skip += 1
+
+    def handle_endtag(self, tag):
+        if tag in ('script', 'style') and self._skip:
+            self._skip -= 1
+
+    def handle_data(self, data):
+        if not self._skip:
+            self.handle_words(_words(data))
+
+    def handle_words(self, words):
+        pass
+
+    def feed_file(self, fileobj):
+        """ Feed content of (utf-8 encoded) `fileobj` read in chunks. """
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        while True:
+            data = fileobj.read(ZipReader.READ_SIZE)
+            if not data:
+                break
+            self.feed(decoder.decode(data))
+        self.feed(decoder.decode(b'', True))
+
+
+class _WordCounter(_TextParser):
+    """ Count words in (x)html text. """
+
+    def __init__(self):
+        _TextParser.__init__(self)
+        self.words = 0
+
+    def handle_words(self, words):
+        self.words += len(words)
+
+
+class _TextSketch(_TextParser):
+    """ Bottom-k sketch of word shingles from (x)html text. """
+
+    def __init__(self):
+        _TextParser.__init__(self)
+        self.hashes = set()
+        self._heap = []  # negated hashes
+        self._window = collections.deque(maxlen=SHINGLE_SIZE)
+
+    def handle_words(self, words):
+        for word in words:
+            self._window.append(word)
+            if len(self._window) == SHINGLE_SIZE:
+                self.add(zlib.crc32(' '.join(self._window).encode('utf-8'))
+                         & 0xffffffff)
+
+    def add(self, value):
+        if value in self.hashes:
+            return
+        if len(self._heap) < SKETCH_SIZE:
+            heapq.heappush(self._heap, -value)
+            self.hashes.add(value)
+        elif value < -self._heap[0]:
+            self.hashes.discard(-heapq.heapreplace(self._heap, -value))
+            self.hashes.add(value)
+
+
+def content_fingerprint(epub):
+    """ Get sketch (sorted list of hashes) of text from spine documents.
+
+    Books with too little text (e.g. comics) get sketch of CRC and size of
+    spine documents and images taken from zip directory.
+    """
+    sketch = _TextSketch()
+    with zipfile.ZipFile(epub, "r") as zipf:
+        with zipf.open(CONTAINER_XML) as contf:
+            opf_path = get_content_opf_path(contf.read())
+        with zipf.open(opf_path) as opffile:
+            items, spine = read_manifest(opffile)
+        base = posixpath.dirname(opf_path)
+        names = [_member_name(base, href)
+                 for href in spine_documents(items, spine)]
+        for name in names:
+            try:
+                member = zipf.open(name)
+            except KeyError:
+                continue
+            with member:
+                sketch.feed_file(member)
+        sketch.close()
+        if not sketch.hashes:
+            names.extend(_member_name(base, href)
+                         for href, media_type in items.values()
+                         if href and media_type and
+                         media_type.startswith('image/'))
+            for name in names:
+                try:
+                    info = zipf.getinfo(name)
+                except KeyError:
+                    continue
+                sketch.add(zlib.crc32(('%d %d' % (
+                    info.CRC, info.file_size)).encode('ascii')) & 0xffffffff)
+    return sorted(sketch.hashes)
+
+
+def _fingerprint_file(fname):
+    try:
+        return fname, content_fingerprint(fname)
+    except Exception:  # pylint: disable=broad-except
+        # book can't be compared; skip it
+        return fname, None
+
+
+def similarity(sketch1, sketch2):
+    """ Estimate Jaccard similarity of texts by bottom-k sketches. """
+    union = sorted(set(sketch1) | set(sketch2))[:SKETCH_SIZE]
+    if not union:
+        return 0.0
+    sketch1, sketch2 = set(sketch1), set(sketch2)
+    common = sum(1 for value in union if value in sketch1 and value in sketch2)
+    return float(common) / len(union)
+
+
+def _join_groups(groups):
+    """ Merge groups (lists) that share any item; return list of sets with
+    more than one item. """
+    parent = {}
+
+    def find(item):
+        root = item
+        while parent.get(root, root) != root:
+            root = parent[root]
+        while item != root:
+            parent[item], item = root, parent[item]
+        return root
+
+    for group in groups:
+        first = find(group[0])
+        parent.setdefault(first, first)
+        for item in group[1:]:
+            root = find(item)
+            if root != first:
+                parent[root] = first
+    components = collections.defaultdict(set)
+    for item in parent:
+        components[find(item)].add(item)
+    return [group for group in components.values() if len(group) > 1]
+
+
+def find_duplicates(records, jobs=None):
+    """ Find duplicated books in `records` (see process_file).
+
+    Books are bucketed by book_keys; candidates are confirmed by similarity
+    of content (see content_fingerprint), bucketed again by smallest hashes
+    of sketches, so large buckets are not compared pairwise. Return list of
+    sorted lists of paths.
+    """
+    buckets = collections.defaultdict(list)
+    for record in records:
+        if record['tags']:
+            for key in book_keys(record['tags']):
+                buckets[key].append(record['path'])
+    candidates = _join_groups([paths for paths in buckets.values()
+                               if len(paths) > 1])
+    del buckets
+    fingerprints = dict(process_files_parallel(
+        sorted(itertools.chain.from_iterable(candidates)), jobs,
+        _fingerprint_file))
+    similar = []
+    for group in candidates:
+        bands = collections.defaultdict(list)
+        for path in sorted(group):
+            for value in (fingerprints[path] or ())[:DUPLICATE_BANDS]:
+                bands[value].append(path)
+        compared = set()
+        for paths in bands.values():
+            for idx, path1 in enumerate(paths):
+                for path2 in paths[idx + 1:]:
+                    if (path1, path2) in compared:
+                        continue
+                    compared.add((path1, path2))
+                    if similarity(fingerprints[path1],
+                                  fingerprints[path2]) >= \
+                            DUPLICATE_SIMILARITY:
+                        similar.append([path1, path2])
+    return sorted(sorted(group) for group in _join_groups(similar))
+
+
+TEXT_MEDIA_TYPES = ('application/xhtml+xml', 'text/html')
+
+
+def book_stats(epub):
+    """ Get statistics of epub content.
+
+    Sizes are taken from zip directory; only (x)html documents are read (in
+    chunks) to count words.
+    """
+    stats = {'media_types': {}, 'images': 0, 'image_bytes': 0, 'words': 0,
+             'compressed': 0, 'size': 0}
+    with zipfile.ZipFile(epub, "r") as zipf:
+        media_types = {}
+        try:
+            with zipf.open(CONTAINER_XML) as contf:
+                opf_path = get_content_opf_path(contf.read())
+            with zipf.open(opf_path) as opffile:
+                items, _spine = read_manifest(opffile)
+            base = posixpath.dirname(opf_path)
+            media_types = dict((_member_name(base, href), media_type)
+                               for href, media_type in items.values()
+                               if href and media_type)
+        except (KeyError, et.ParseError):
+            pass
+        counter = _WordCounter()
+        for info in zipf.infolist():
+            if info.filename.endswith('/'):
+                continue
+            media_type = media_types.get(info.filename) or \
+                mimetypes.guess_type(info.filename)[0] or \
+                'application/octet-stream'
+            mstats = stats['media_types'].setdefault(
+                media_type, {'count': 0, 'compressed': 0, 'size': 0})
+            mstats['count'] += 1
+            mstats['compressed'] += info.compress_size
+            mstats['size'] += info.file_size
+            stats['compressed'] += info.compress_size
+            stats['size'] += info.file_size
+            if media_type.startswith('image/'):
+                stats['images'] += 1
+                stats['image_bytes'] += info.file_size
+            elif media_type in TEXT_MEDIA_TYPES:
+                with zipf.open(info) as member:
+                    counter.feed_file(member)
+                counter.close()
+                counter.reset()
+        stats['words'] = counter.words
+    return stats
+
+
+def process_stats(fname):
+    """ Get statistics of epub; return record for batch mode:
+    {"path": fname, "stats": stats, "error": error message or None}.
+    """
+    record = {'path': fname, 'stats': None, 'error': file_error(fname)}
+    if record['error']:
+        return record
+    try:
+        record['stats'] = book_stats(fname)
+    except Exception as err:  # pylint: disable=broad-except
+        # any problem with one book must not break batch
+        record['error'] = _error_message(err)
+    return record
+
+
+def show_stats(record):
+    """ Display record created by process_stats. """
+    print(record['path'])
+    if record['error']:
+        print('ERROR:', record['error'])
+    else:
+        stats = record['stats']
+        print('\t%-30s %6s %12s %12s' % ('Media type', 'Count',
+                                          'Compressed', 'Size'))
+        for media_type, mstats in sorted(stats['media_types'].items()):
+            print('\t%-30s %6d %12d %12d' % (media_type, mstats['count'],
+                                              mstats['compressed'],
+                                              mstats['size']))
+        print('\t%-30s %6s %12d %12d' % ('Total', '', stats['compressed'],
+                                          stats['size']))
+        print('\tImages: %d (%d bytes)' % (stats['images'],
+                                            stats['image_bytes']))
+        print('\tWords: %d' % stats['words'])
+    print()
+
+
+def show_record(record):
+    """ Display record created by process_file. """
+    print(record['path'])
+    if record['error']:
+        print('ERROR:', record['error'])
+    elif record['tags']:
+        show(record['tags'])
+    print()
 
 
 def _parse_opt():
     """ Parse cli options. """
-    optp = optparse.OptionParser(usage="%prog [options] files",
+    optp = optparse.OptionParser(usage="%prog [options] files\n"
+                                 "       %prog --cache DB [options] query "
+                                 "[field:]word[*] ...",
                                  version="%prog " + VERSION,
                                  description=__doc__)
+    optp.add_option('--recursive', '-r', action="store_true", default=False,
+                    help='find epub files in given directories')
+    optp.add_option('--json', action="store_true", default=False,
+                    help='print one JSON record per book (in order of '
+                    'processing)')
+    optp.add_option('--jobs', '-j', type="int", default=None,
+                    help='number of worker processes for --json '
+                    '(default: number of CPUs)')
+    optp.add_option('--duplicates', action="store_true", default=False,
+                    help='find duplicated books')
+    optp.add_option('--stats', action="store_true", default=False,
+                    help='show statistics of books content')
+    optp.add_option('--cache', metavar='DB',
+                    help='keep metadata in SQLite database DB; parse only '
+                    'new and changed books')
 #    group = optparse.OptionGroup(optp, "Debug options")
 #    group.add_option('--debug', '-d', action="store_true", default=False,
 #                     help='enable debug messages')
@@ -177,21 +1111,72 @@ def _parse_opt():
     return optp.parse_args()
 
 
+def show_duplicates(groups, as_json):
+    for group in groups:
+        if as_json:
+            show_json({'paths': group})
+        else:
+            print('\n'.join(group))
+            print()
+
+
+def query(opts, args):
+    """ Search books in cache and print paths or (--json) records. """
+    if not opts.cache:
+        print('ERROR: missing --cache database to search')
+        exit(-1)
+    try:
+        conditions = parse_query(args)
+    except ValueError as err:
+        print('ERROR: %s' % err)
+        exit(-1)
+    if not conditions:
+        print('ERROR: missing query')
+        exit(-1)
+    cache = MetadataCache(opts.cache)
+    try:
+        for record in cache.query(conditions):
+            if opts.json:
+                show_json(record)
+            else:
+                print(record['path'])
+    finally:
+        cache.close()
+
+
 def main():
-    _opts, args = _parse_opt()
+    opts, args = _parse_opt()
     if not args:
-        print 'ERROR: missing files to process'
+        print('ERROR: missing files to process')
         exit(-1)
-    for fname in args:
-        fname = get_full_filename(fname)
-        print fname
-        if check_file(fname):
-            opf = get_opf(fname)
-            if opf:
-                elements = process_opf(opf)
-                groups = group_tags(elements)
-                show(groups)
-        print
+    if args[0] == 'query':
+        query(opts, args[1:])
+        return
+    fnames = find_files(args, opts.recursive)
+    if opts.stats:
+        for record in process_files_parallel(fnames, opts.jobs,
+                                             process_stats):
+            (show_json if opts.json else show_stats)(record)
+        return
+    cache = MetadataCache(opts.cache) if opts.cache else None
+    try:
+        if cache:
+            roots = [get_full_filename(arg) for arg in args] \
+                if opts.recursive else []
+            roots = [root for root in roots if os.path.isdir(root)]
+            records = process_files_cached(fnames, cache, opts.jobs, roots)
+        elif opts.json or opts.duplicates:
+            records = process_files_parallel(fnames, opts.jobs)
+        else:
+            records = (process_file(fname) for fname in fnames)
+        if opts.duplicates:
+            show_duplicates(find_duplicates(records, opts.jobs), opts.json)
+            return
+        for record in records:
+            (show_json if opts.json else show_record)(record)
+    finally:
+        if cache:
+            cache.close()
 
 if __name__ == '__main__':
     main()
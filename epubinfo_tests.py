@@ -0,0 +1,436 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import io
+import json
+import os
+import random
+import shutil
+import struct
+import tempfile
+import unittest
+import zipfile
+
+import epubinfo
+
+
+CONTAINER = b"""<?xml version="1.0"?>
+<container version="1.0"
+    xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles>
+    <rootfile full-path="OEBPS/content.opf"
+        media-type="application/oebps-package+xml"/>
+  </rootfiles>
+</container>
+"""
+
+OPF = u"""<?xml version="1.0" encoding="utf-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="2.0">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/"
+      xmlns:opf="http://www.idpf.org/2007/opf">
+    <dc:title>%(title)s</dc:title>
+    <dc:creator opf:role="aut">%(creator)s</dc:creator>
+    <dc:identifier opf:scheme="ISBN">%(isbn)s</dc:identifier>
+    <dc:language>pl</dc:language>
+    <dc:subject>Fiction</dc:subject>
+    <dc:date>2014-12-22</dc:date>
+    <meta name="calibre:series" content="Test"/>
+  </metadata>
+  <manifest>
+    <item id="ch1" href="ch1.xhtml" media-type="application/xhtml+xml"/>
+  </manifest>
+  <spine>
+    <itemref idref="ch1"/>
+  </spine>
+</package>
+"""
+
+CHAPTER = u"""<?xml version="1.0" encoding="utf-8"?>
+<html xmlns="http://www.w3.org/1999/xhtml"><body>
+<p>%(text)s</p>
+</body></html>
+"""
+
+
+def _break_last_member(fname):
+    """ Change compression method of last member to unsupported one. """
+    with open(fname, 'r+b') as zfile:
+        content = zfile.read()
+        zfile.seek(content.rindex(b'PK\003\004') + 8)
+        zfile.write(b'\x63\x00')
+        zfile.seek(content.rindex(b'PK\001\002') + 10)
+        zfile.write(b'\x63\x00')
+
+
+def create_epub(fname, title=u"Tytuł", creator=u"Autor", isbn=u"1234567890",
+                text=u"Ala ma kota", image=None):
+    params = {'title': title, 'creator': creator, 'isbn': isbn, 'text': text}
+    opf = OPF % params
+    if image is not None:
+        opf = opf.replace(u'</manifest>', u'  <item id="img" href="img.jpg" '
+                          u'media-type="image/jpeg"/>\n  </manifest>')
+    with zipfile.ZipFile(fname, 'w') as zipf:
+        zipf.writestr(zipfile.ZipInfo('mimetype'), b'application/epub+zip')
+        zipf.writestr('META-INF/container.xml', CONTAINER,
+                      zipfile.ZIP_DEFLATED)
+        zipf.writestr('OEBPS/content.opf', opf.encode('utf-8'),
+                      zipfile.ZIP_DEFLATED)
+        zipf.writestr('OEBPS/ch1.xhtml', (CHAPTER % params).encode('utf-8'),
+                      zipfile.ZIP_DEFLATED)
+        if image is not None:
+            zipf.writestr('OEBPS/img.jpg', image)
+    return fname
+
+
+class _LibraryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.tmpdir, 'a', 'b'))
+        self.books = [
+            create_epub(os.path.join(self.tmpdir, 'a', 'book1.epub')),
+            create_epub(os.path.join(self.tmpdir, 'a', 'b', 'book2.EPUB'),
+                        title=u"Other"),
+        ]
+        self.broken = os.path.join(self.tmpdir, 'a', 'broken.epub')
+        with open(self.broken, 'wb') as ofile:
+            ofile.write(b'not a zip file')
+        with open(os.path.join(self.tmpdir, 'a', 'notes.txt'), 'w') as ofile:
+            ofile.write('notes')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+
+class TestBatch(_LibraryTestCase):
+    def test_find_files(self):
+        found = list(epubinfo.find_files([self.tmpdir], True))
+        self.assertEqual(sorted(found), sorted(self.books + [self.broken]))
+
+    def test_process_file(self):
+        record = epubinfo.process_file(self.books[0])
+        self.assertIsNone(record['error'])
+        self.assertEqual(record['path'], self.books[0])
+        self.assertEqual(record['tags']['title'][0][2], u"Tytuł")
+        self.assertEqual(record['tags']['creator'][0][1], u"aut")
+        self.assertEqual(record['tags']['calibre'][0][1:3],
+                         ('series', 'Test'))
+
+    def test_process_file_error(self):
+        record = epubinfo.process_file(self.broken)
+        self.assertIsNone(record['tags'])
+        self.assertTrue(record['error'])
+
+    def test_parallel(self):
+        fnames = epubinfo.find_files([self.tmpdir], True)
+        records = list(epubinfo.process_files_parallel(fnames, 2))
+        self.assertEqual(sorted(rec['path'] for rec in records),
+                         sorted(self.books + [self.broken]))
+        errors = [rec['path'] for rec in records if rec['error']]
+        self.assertEqual(errors, [self.broken])
+
+    def test_bad_container(self):
+        bad = os.path.join(self.tmpdir, 'a', 'bad_container.epub')
+        with zipfile.ZipFile(bad, 'w') as zipf:
+            zipf.writestr('mimetype', b'application/epub+zip')
+            zipf.writestr('META-INF/container.xml', CONTAINER.replace(
+                b'rootfiles', b'other'))
+        fnames = epubinfo.find_files([self.tmpdir], True)
+        records = list(epubinfo.process_files_parallel(fnames, 1))
+        errors = sorted(rec['path'] for rec in records if rec['error'])
+        self.assertEqual(errors, sorted([bad, self.broken]))
+
+    def test_parallel_stop(self):
+        fnames = (os.path.join(self.tmpdir, 'missing%d' % idx)
+                  for idx in range(100))
+        results = epubinfo.process_files_parallel(fnames, 1)
+        next(results)
+        # must not hang
+        results.close()
+
+
+class TestIterOpf(unittest.TestCase):
+    def test_same_as_process_opf(self):
+        opf = (OPF % {'title': u"Tytuł", 'creator': u"Autor",
+                      'isbn': u"1"}).encode('utf-8')
+        self.assertEqual(list(epubinfo.iter_opf(io.BytesIO(opf))),
+                         list(epubinfo.process_opf(opf)))
+
+    def test_stop_after_metadata(self):
+        opf = (OPF % {'title': u"Tytuł", 'creator': u"Autor",
+                      'isbn': u"1"}).encode('utf-8')
+        # broken xml after metadata is never read
+        opf = opf.replace(b'<manifest>', b'<manifest><<<')
+        tags = list(epubinfo.iter_opf(io.BytesIO(opf)))
+        self.assertEqual(len(tags), 7)
+
+
+class TestZipReader(_LibraryTestCase):
+    def test_read_members(self):
+        fname = os.path.join(self.tmpdir, 'test.zip')
+        data = os.urandom(200 * 1024) + b'x' * 300 * 1024
+        with zipfile.ZipFile(fname, 'w') as zipf:
+            zipf.writestr('stored', data, zipfile.ZIP_STORED)
+            zipf.writestr('deflated', data, zipfile.ZIP_DEFLATED)
+            zipf.writestr(u'zażółć', b'', zipfile.ZIP_DEFLATED)
+        with epubinfo.ZipReader(fname) as zipf:
+            self.assertEqual(sorted(zipf.members),
+                             sorted(['stored', 'deflated', u'zażółć']))
+            for name in ('stored', 'deflated'):
+                with zipf.open(name) as member:
+                    self.assertEqual(member.read(1000), data[:1000])
+                    self.assertEqual(member.read(), data[1000:])
+            self.assertEqual(zipf.open(u'zażółć').read(), b'')
+            self.assertRaises(KeyError, zipf.open, 'missing')
+
+    def test_bad_crc(self):
+        fname = os.path.join(self.tmpdir, 'test.zip')
+        with zipfile.ZipFile(fname, 'w') as zipf:
+            zipf.writestr('stored', b'abcdef', zipfile.ZIP_STORED)
+        with open(fname, 'r+b') as zfile:
+            content = zfile.read()
+            zfile.seek(content.index(b'abcdef'))
+            zfile.write(b'ABCDEF')
+        with epubinfo.ZipReader(fname) as zipf:
+            self.assertRaises(zipfile.BadZipfile,
+                              zipf.open('stored').read)
+
+    def test_long_directory(self):
+        fname = os.path.join(self.tmpdir, 'test.zip')
+        with zipfile.ZipFile(fname, 'w') as zipf:
+            for idx in range(1000):
+                zipf.writestr('file%04d' % idx, b'%d' % idx)
+        with epubinfo.ZipReader(fname) as zipf:
+            self.assertEqual(len(zipf.members), 1000)
+            self.assertEqual(zipf.open('file0999').read(), b'999')
+
+    def test_zip64_end_record(self):
+        with open(self.books[0], 'rb') as zfile:
+            content = zfile.read()
+        eocd = content.rindex(b'PK\005\006')
+        entries, cdir_size, cdir_offset = struct.unpack_from(
+            '<HLL', content, eocd + 10)
+        # zip64 end of central directory record and locator
+        record = struct.pack('<4sQ2H2L4Q', b'PK\006\006', 44, 45, 45, 0, 0,
+                             entries, entries, cdir_size, cdir_offset)
+        locator = struct.pack('<4sLQL', b'PK\006\007', 0, eocd, 1)
+        fname = os.path.join(self.tmpdir, 'zip64.epub')
+        with open(fname, 'wb') as zfile:
+            zfile.write(content[:eocd] + record + locator + content[eocd:])
+        self.assertRaises(epubinfo._Unsupported, epubinfo.ZipReader, fname)
+        self.assertEqual(epubinfo.load_opf_tags(fname),
+                         epubinfo.load_opf_tags(self.books[0]))
+
+    def test_not_zip(self):
+        self.assertRaises(zipfile.BadZipfile, epubinfo.load_opf_tags,
+                          self.broken)
+
+    def test_same_as_zipfile(self):
+        with zipfile.ZipFile(self.books[0]) as zipf:
+            expected = list(epubinfo.iter_opf(zipf.open(
+                'OEBPS/content.opf')))
+        self.assertEqual(epubinfo.load_opf_tags(self.books[0]), expected)
+
+
+def _as_json(records):
+    return sorted(json.dumps(rec, sort_keys=True) for rec in records)
+
+
+class _CacheTestCase(_LibraryTestCase):
+    """ Library test case with `_scan` through MetadataCache. """
+
+    def setUp(self):
+        _LibraryTestCase.setUp(self)
+        self.dbfile = os.path.join(self.tmpdir, 'cache.db')
+        self.parsed = []
+        self._orig_parallel = epubinfo.process_files_parallel
+
+        def process_files_parallel(fnames, jobs=None):
+            fnames = list(fnames)
+            self.parsed.extend(fnames)
+            return map(epubinfo.process_file, fnames)
+
+        epubinfo.process_files_parallel = process_files_parallel
+
+    def tearDown(self):
+        epubinfo.process_files_parallel = self._orig_parallel
+        _LibraryTestCase.tearDown(self)
+
+    def _scan(self):
+        del self.parsed[:]
+        cache = epubinfo.MetadataCache(self.dbfile)
+        try:
+            fnames = epubinfo.find_files([self.tmpdir], True)
+            return list(epubinfo.process_files_cached(
+                fnames, cache, roots=[self.tmpdir]))
+        finally:
+            cache.close()
+
+
+class TestCache(_CacheTestCase):
+    def test_incremental(self):
+        records = self._scan()
+        self.assertEqual(sorted(self.parsed),
+                         sorted(self.books + [self.broken]))
+        self.assertEqual(len(records), 3)
+
+        records2 = self._scan()
+        self.assertEqual(self.parsed, [])
+        self.assertEqual(_as_json(records), _as_json(records2))
+
+        create_epub(self.books[0], title=u"Changed title, longer")
+        records = self._scan()
+        self.assertEqual(self.parsed, [self.books[0]])
+        record = [rec for rec in records if rec['path'] == self.books[0]][0]
+        self.assertEqual(record['tags']['title'][0][2],
+                         u"Changed title, longer")
+
+    def test_prune(self):
+        self._scan()
+        os.unlink(self.books[1])
+        self._scan()
+        cache = epubinfo.MetadataCache(self.dbfile)
+        try:
+            rows = cache._conn.execute("SELECT count(*) FROM books")
+            self.assertEqual(rows.fetchone()[0], 2)
+        finally:
+            cache.close()
+
+
+class TestQuery(_CacheTestCase):
+    def _query(self, *args):
+        cache = epubinfo.MetadataCache(self.dbfile)
+        try:
+            records = cache.query(epubinfo.parse_query(args))
+        finally:
+            cache.close()
+        return [record['path'] for record in records]
+
+    def test_query(self):
+        self._scan()
+        books = sorted(self.books)
+        self.assertEqual(self._query('creator:autor'), books)
+        self.assertEqual(self._query('tytuł'), [self.books[0]])
+        self.assertEqual(self._query('title:oth*'), [self.books[1]])
+        self.assertEqual(self._query('title:ot'), [])
+        self.assertEqual(self._query('language:pl', 'date:2014*'), books)
+        self.assertEqual(self._query('identifier:1234567890',
+                                     'title:other'), [self.books[1]])
+        self.assertEqual(self._query('subject:fiction', 'missing'), [])
+        self.assertRaises(ValueError, epubinfo.parse_query, ['bad:x'])
+
+    def test_update(self):
+        self._scan()
+        create_epub(self.books[0], title=u"Nowy tytuł")
+        os.unlink(self.books[1])
+        self._scan()
+        self.assertEqual(self._query('title:nowy'), [self.books[0]])
+        self.assertEqual(self._query('title:other'), [])
+        self.assertEqual(self._query('autor'), [self.books[0]])
+
+
+def _text(seed, words=2000):
+    rnd = random.Random(seed)
+    return u' '.join(u'word%d' % rnd.randint(0, 5000) for _idx in range(words))
+
+
+class TestDuplicates(_LibraryTestCase):
+    def test_book_keys(self):
+        tags = epubinfo.process_file(self.books[0])['tags']
+        self.assertEqual(epubinfo.book_keys(tags),
+                         set([('isbn', '9781234567897'),
+                              ('title', u'tytuł|autor')]))
+
+    def test_find_duplicates(self):
+        text = _text(1)
+
+        def path(name):
+            return os.path.join(self.tmpdir, name)
+
+        books = [
+            # same book, other isbn form and markup
+            create_epub(path('c1.epub'), isbn=u'978-1-23-456789-7',
+                        text=text),
+            create_epub(path('c2.epub'), title=u"Tytuł!", text=text.replace(
+                u' word1 ', u'</p><p> word1 <b>b</b> ')),
+            # same title and author, other text
+            create_epub(path('c3.epub'), isbn=u'', text=_text(2)),
+            # similar text, other metadata
+            create_epub(path('c4.epub'), title=u"X", creator=u"Y",
+                        isbn=u'', text=text),
+        ]
+        # text can't be read - skipped
+        broken = create_epub(path('c5.epub'), text=text)
+        _break_last_member(broken)
+        records = [epubinfo.process_file(book) for book in books + [broken]]
+        self.assertEqual(epubinfo.find_duplicates(records, 2),
+                         [books[:2]])
+
+    def test_find_duplicates_without_text(self):
+        # too few words for text sketch; copies and other images
+        books = [create_epub(os.path.join(self.tmpdir, name + '.epub'),
+                             image=image * 1000)
+                 for name, image in (('c1', b'1'), ('c2', b'1'),
+                                     ('c3', b'2'))]
+        records = [epubinfo.process_file(book) for book in books]
+        self.assertEqual(epubinfo.find_duplicates(records, 1), [books[:2]])
+
+    def test_find_duplicates_large_bucket(self):
+        books = [create_epub(os.path.join(self.tmpdir, 'c%d.epub' % idx),
+                             creator=u'', isbn=u'', text=_text(idx, 200))
+                 for idx in range(30)]
+        books.append(create_epub(os.path.join(self.tmpdir, 'copy.epub'),
+                                 creator=u'', isbn=u'', text=_text(0, 200)))
+        records = [epubinfo.process_file(book) for book in books]
+        compared = []
+        orig_similarity = epubinfo.similarity
+
+        def similarity(sketch1, sketch2):
+            compared.append(1)
+            return orig_similarity(sketch1, sketch2)
+
+        epubinfo.similarity = similarity
+        try:
+            self.assertEqual(epubinfo.find_duplicates(records, 2),
+                             [sorted([books[0], books[-1]])])
+        finally:
+            epubinfo.similarity = orig_similarity
+        self.assertLess(len(compared), len(books))
+
+
+class TestStats(_LibraryTestCase):
+    def test_stats(self):
+        image = os.urandom(5000)
+        with zipfile.ZipFile(self.books[0], 'a') as zipf:
+            zipf.writestr('OEBPS/cover.jpg', image)
+            zipf.writestr('OEBPS/img.png', image, zipfile.ZIP_DEFLATED)
+        record = epubinfo.process_stats(self.books[0])
+        self.assertIsNone(record['error'])
+        stats = record['stats']
+        self.assertEqual(stats['images'], 2)
+        self.assertEqual(stats['image_bytes'], 10000)
+        self.assertEqual(stats['words'], 3)
+        self.assertEqual(stats['media_types']['image/jpeg'],
+                         {'count': 1, 'compressed': 5000, 'size': 5000})
+        self.assertEqual(stats['media_types']['application/xhtml+xml']
+                         ['count'], 1)
+        with zipfile.ZipFile(self.books[0]) as zipf:
+            self.assertEqual(stats['size'], sum(info.file_size for info
+                                                in zipf.infolist()))
+
+    def test_stats_error(self):
+        record = epubinfo.process_stats(self.broken)
+        self.assertIsNone(record['stats'])
+        self.assertTrue(record['error'])
+
+    def test_stats_unsupported_member(self):
+        with zipfile.ZipFile(self.books[0], 'a') as zipf:
+            zipf.writestr('OEBPS/ch2.xhtml', b'<p>text</p>',
+                          zipfile.ZIP_DEFLATED)
+        _break_last_member(self.books[0])
+        record = epubinfo.process_stats(self.books[0])
+        self.assertIsNone(record['stats'])
+        self.assertTrue(record['error'])
+
+
+if __name__ == '__main__':
+    unittest.main()
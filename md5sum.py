@@ -4,6 +4,16 @@
 Generate / check md5sum.txt.
 
 Optionally add sums only for new/updated files.
+Other manifests (sha1sum.txt, sha256sum.txt, ...) can be created in the same
+pass; check verify all manifests found next to md5sum.txt.
+Fast check verify only size and few samples of each file.
+Tree mode store digest of each directory, so copies can be compared by
+descending only into differing directories.
+Find duplicated files.
+Manifests can be converted to indexed, compressed format (.idx) that allow
+lookup of single file without reading whole manifest.
+Watch mode keep manifest up to date using inotify (Linux only).
+Hashing statistics can be written as NDJSON.
 """
 
 from __future__ import with_statement
@@ -18,79 +28,1124 @@ __version__ = "0.2"
 import os
 import sys
 import io
+import errno
+import array
+import binascii
+import bisect
+import collections
+import heapq
+import struct
+import zlib
+import select
+import ctypes
+import ctypes.util
+import json
+import atexit
 import hashlib
+import mmap
+import time
+import threading
+from multiprocessing.pool import ThreadPool
 from optparse import OptionParser
 
+try:
+    input = raw_input
+except NameError:
+    pass
+
 
 MD5SUMFILENAME = 'md5sum.txt'
+# algorithm -> manifest file name
+MANIFESTS = {
+    'md5': MD5SUMFILENAME,
+    'sha1': 'sha1sum.txt',
+    'sha224': 'sha224sum.txt',
+    'sha256': 'sha256sum.txt',
+    'sha384': 'sha384sum.txt',
+    'sha512': 'sha512sum.txt',
+    'blake2b': 'b2sum.txt',
+}
+# digest length -> algorithm; for manifests with unknown names
+DIGEST_LEN_ALGORITHMS = {32: 'md5', 40: 'sha1', 56: 'sha224', 64: 'sha256',
+                         96: 'sha384', 128: 'sha512'}
+ALGORITHMS = ('md5', )
+CACHE_SUFFIX = '.cache'
+SAMPLE_SUFFIX = '.sample'
+TREE_SUFFIX = '.tree'
+JOURNAL_SUFFIX = '.journal'
+INDEX_SUFFIX = '.idx'
+INDEX_MAGIC = b'MD5SUMIDX1\n'
+# index footer: index offset, index length, number of entries
+INDEX_FOOTER = struct.Struct('<QQQ')
+INDEX_BLOCK_ENTRIES = 1024
+# duplicates: size of head compared before full hash
+DUP_HEAD_SIZE = 64*1024
+# watch: write manifest after WATCH_DEBOUNCE seconds without changes, but
+# not later than WATCH_MAX_DELAY seconds after first change
+WATCH_DEBOUNCE = 5
+WATCH_MAX_DELAY = 60
+# max time in seconds between journal syncs
+JOURNAL_SYNC_INTERVAL = 10
+# fast check: size of each sample and number of samples between head and tail
+SAMPLE_SIZE = 64*1024
+SAMPLE_POINTS = 3
 BSIZE = 8192*1024
+# use mmap for files larger than MMAP_MIN_SIZE when USE_MMAP
+USE_MMAP = False
+MMAP_MIN_SIZE = 64*1024*1024
+# drop read data from page cache (posix_fadvise); read with O_DIRECT
+FADVISE = False
+DIRECT_IO = False
+# hash files from each device by separate readers; see hash_files_by_device
+# max number of results (also of placeholders) waiting in _imap
+IMAP_WINDOW = 4096
+BY_DEVICE = False
+# Stats object when collecting statistics
+STATS = None
+# min time in seconds between progress updates
+PROGRESS_INTERVAL = 0.5
 COLOR_OK = '\033[92m'
 COLOR_WARNING = '\033[93m'
 COLOR_FAIL = '\033[91m'
 COLOR_END = '\033[0m'
 
+_timer = getattr(time, 'perf_counter', time.time)
 
-def get_file_sum(filename):
-    md5 = hashlib.md5()
-    total, last_perc = 0, -5
-    size = os.path.getsize(filename)
-    print(filename, '       ', end="")
-    with io.open(filename, 'rb') as file2check:
-        while True:
-            data = file2check.read(BSIZE)
-            if not data:
+
+class Stats(object):
+    """ Collect hashing statistics; write NDJSON record for each file and
+    summary to `output`.
+
+    Read time is time of hashing file minus time spent in hash functions.
+    `filename` of `output` is skipped when generating sums.
+    """
+
+    def __init__(self, output, filename=None):
+        self._output = output
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._start = _timer()
+        self.files = 0
+        self.bytes = 0
+        self.read_time = 0.0
+        self.hash_time = 0.0
+
+    def _write(self, record):
+        self._output.write(json.dumps(record, sort_keys=True) + '\n')
+        self._output.flush()
+
+    def add(self, filename, size, wall, hash_time):
+        read_time = max(wall - hash_time, 0.0)
+        with self._lock:
+            self.files += 1
+            self.bytes += size
+            self.read_time += read_time
+            self.hash_time += hash_time
+            self._write({'file': filename, 'bytes': size,
+                         'wall': round(wall, 6), 'read': round(read_time, 6),
+                         'hash': round(hash_time, 6),
+                         'mbps': round(size / 1000000.0 / max(wall, 1e-6),
+                                       2)})
+
+    def summary(self):
+        wall = _timer() - self._start
+        with self._lock:
+            self._write({'summary': True, 'files': self.files,
+                         'bytes': self.bytes, 'wall': round(wall, 6),
+                         'read': round(self.read_time, 6),
+                         'hash': round(self.hash_time, 6),
+                         'mbps': round(self.bytes / 1000000.0 /
+                                       max(wall, 1e-6), 2),
+                         'bound': 'io' if self.read_time > self.hash_time
+                                  else 'cpu'})
+
+
+def _open_file(filename):
+    """ Open file for reading; when DIRECT_IO try to use O_DIRECT. """
+    if DIRECT_IO and hasattr(os, 'O_DIRECT'):
+        try:
+            fdesc = os.open(filename, os.O_RDONLY | os.O_DIRECT)
+        except OSError as err:
+            # i.e. tmpfs not support O_DIRECT
+            if err.errno != errno.EINVAL:
+                raise
+        else:
+            return io.FileIO(fdesc, 'r')
+    return io.open(filename, 'rb', buffering=0)
+
+
+def _fadvise(fdesc, offset, length, advice):
+    if FADVISE and hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fdesc, offset, length, advice)
+
+
+if bytes is str:  # python2
+    def _encode_name(name):
+        return name
+
+    _decode_name = _encode_name
+else:
+    def _encode_name(name):
+        return name.encode('utf-8', 'surrogateescape')
+
+    def _decode_name(name):
+        return name.decode('utf-8', 'surrogateescape')
+
+
+def _open_text(filename, mode='r'):
+    """ Open manifest or sidecar file; file names that are not valid utf-8
+    are kept as in _encode_name / _decode_name. """
+    if bytes is str:  # python2
+        return open(filename, mode + 'b')
+    return io.open(filename, mode, encoding='utf-8', errors='surrogateescape',
+                   newline='\n')
+
+
+class Sums(object):
+    """ Compact mapping path -> hex digest for large manifests.
+
+    Directory names are interned, file names are kept in one bytes pool and
+    digests as binary in another, so entry cost few dozen bytes instead of
+    few hundreds for dict of strings.
+    Entries added in path order are kept sorted and searched by bisect;
+    entries added out of order are indexed in `_tail` and merged when
+    iterating. Iteration is always in path order.
+    """
+
+    def __init__(self):
+        self._dirs = []
+        self._dirs_index = {}
+        self._dir = array.array('L')
+        self._name_off = array.array('L', [0])
+        self._names = bytearray()
+        self._digests = bytearray()
+        self._digest_size = None
+        # number of entries in sorted part and last path in it
+        self._sorted_cnt = 0
+        self._last = None
+        self._tail = {}
+
+    def __len__(self):
+        return len(self._dir)
+
+    def _path(self, idx):
+        dirname = self._dirs[self._dir[idx]]
+        name = _decode_name(bytes(
+            self._names[self._name_off[idx]:self._name_off[idx + 1]]))
+        return dirname + '/' + name if dirname else name
+
+    def _digest(self, idx):
+        size = self._digest_size
+        digest = binascii.hexlify(
+            bytes(self._digests[idx * size:(idx + 1) * size]))
+        # python2: keep str; unicode can't be joined with not-ascii names
+        return digest if bytes is str else digest.decode('ascii')
+
+    def _bisect(self, path, low=0):
+        """ Find first index in sorted part with path >= `path`. """
+        high = self._sorted_cnt
+        while low < high:
+            mid = (low + high) // 2
+            if self._path(mid) < path:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def _find(self, path):
+        idx = self._bisect(path)
+        if idx < self._sorted_cnt and self._path(idx) == path:
+            return idx
+        return self._tail.get(path)
+
+    def __contains__(self, path):
+        return self._find(path) is not None
+
+    def get(self, path, default=None):
+        idx = self._find(path)
+        return default if idx is None else self._digest(idx)
+
+    def __getitem__(self, path):
+        idx = self._find(path)
+        if idx is None:
+            raise KeyError(path)
+        return self._digest(idx)
+
+    def __setitem__(self, path, digest):
+        try:
+            bdigest = binascii.unhexlify(digest)
+        except (TypeError, ValueError):
+            raise ValueError("invalid digest: %r" % digest)
+        if self._digest_size is None:
+            self._digest_size = len(bdigest)
+        elif len(bdigest) != self._digest_size:
+            raise ValueError("invalid digest length: %r" % digest)
+        in_order = not self._tail and (self._last is None or
+                                       path > self._last)
+        # fast path for sorted input - path can't be already stored
+        idx = None if in_order else self._find(path)
+        if idx is not None:
+            size = self._digest_size
+            self._digests[idx * size:(idx + 1) * size] = bdigest
+            return
+        idx = len(self._dir)
+        dirname, name = path.rsplit('/', 1) if '/' in path else ('', path)
+        dir_idx = self._dirs_index.get(dirname)
+        if dir_idx is None:
+            dir_idx = self._dirs_index[dirname] = len(self._dirs)
+            self._dirs.append(dirname)
+        self._dir.append(dir_idx)
+        self._names.extend(_encode_name(name))
+        self._name_off.append(len(self._names))
+        self._digests.extend(bdigest)
+        if in_order:
+            self._sorted_cnt += 1
+            self._last = path
+        else:
+            self._tail[path] = idx
+
+    def __iter__(self):
+        for path, _digest in self.items():
+            yield path
+
+    def items(self):
+        """ Yield (path, hex digest) sorted by path. """
+        sorted_items = ((self._path(idx), self._digest(idx))
+                        for idx in range(self._sorted_cnt))
+        if not self._tail:
+            return sorted_items
+        tail_items = ((path, self._digest(self._tail[path]))
+                      for path in sorted(self._tail))
+        return heapq.merge(sorted_items, tail_items)
+
+    def dir_items(self, dirpath):
+        """ Yield (name, hex digest) of files directly in `dirpath`.
+
+        `dirpath` must end with "/"; subdirectories are skipped by bisect, so
+        cost not depend on size of subtree.
+        """
+        result = []
+        idx = self._bisect(dirpath)
+        while idx < self._sorted_cnt:
+            path = self._path(idx)
+            if not path.startswith(dirpath):
                 break
-            total += len(data)
-            perc = int(100 * total / size)
-            if perc > last_perc:
-                print('\b\b\b\b%3d%%' % perc, end="")
-                last_perc = perc
-            sys.stdout.flush()
-            md5.update(data)
-    digest = md5.hexdigest().lower()
+            name = path[len(dirpath):]
+            if '/' in name:
+                # skip subdirectory; '0' is next char after '/'
+                subdir = name[:name.index('/')]
+                idx = self._bisect(dirpath + subdir + '0', idx)
+                continue
+            result.append((name, self._digest(idx)))
+            idx += 1
+        for path, tidx in self._tail.items():
+            if path.startswith(dirpath) and '/' not in path[len(dirpath):]:
+                result.append((path[len(dirpath):], self._digest(tidx)))
+        return sorted(result)
+
+
+class _Cursor(object):
+    """ Merge cursor over (path, value) `items` sorted by path.
+
+    Paths must be looked up in increasing order, so sorted sidecar files
+    and manifests are merged with sorted walk without loading them into
+    memory. Items out of order are skipped (not found).
+    """
+
+    def __init__(self, items):
+        self._items = iter(items)
+        self.path = self.value = None
+        self.advance()
+
+    def advance(self):
+        """ Move to next item; path is None at the end. """
+        self.path, self.value = next(self._items, (None, None))
+
+    def get(self, path):
+        """ Get value of `path` (None when not found); skip items before. """
+        while self.path is not None and self.path < path:
+            self.advance()
+        return self.value if self.path == path else None
+
+
+def write_index(filename, items):
+    """ Write (path, digest) `items` sorted by path to indexed manifest.
+
+    File contains zlib compressed blocks of INDEX_BLOCK_ENTRIES manifest
+    lines, compressed index (offset, length and first path of each block)
+    and INDEX_FOOTER.
+    """
+    with open(filename, 'wb') as idxfile:
+        idxfile.write(INDEX_MAGIC)
+        index = []
+        count = 0
+        block = []
+        first = None
+
+        def write_block():
+            data = zlib.compress(b''.join(block), 9)
+            index.append(_encode_name('%d %d %s\n' % (
+                idxfile.tell(), len(data), first)))
+            idxfile.write(data)
+
+        for path, digest in items:
+            if not block:
+                first = path
+            block.append(_encode_name('%s  %s\n' % (digest, path)))
+            count += 1
+            if len(block) == INDEX_BLOCK_ENTRIES:
+                write_block()
+                block = []
+        if block:
+            write_block()
+        index_offset = idxfile.tell()
+        data = zlib.compress(b''.join(index), 9)
+        idxfile.write(data)
+        idxfile.write(INDEX_FOOTER.pack(index_offset, len(data), count))
+
+
+class IndexedManifest(object):
+    """ Read-only manifest in format written by `write_index`.
+
+    Only index is loaded; `get` decompress one block.
+    """
+
+    def __init__(self, filename):
+        self._file = open(filename, 'rb')
+        if self._file.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+            raise ValueError("%s is not indexed manifest" % filename)
+        self._file.seek(-INDEX_FOOTER.size, os.SEEK_END)
+        offset, length, self._count = \
+            INDEX_FOOTER.unpack(self._file.read(INDEX_FOOTER.size))
+        self._file.seek(offset)
+        self._blocks = []
+        self._first = []
+        for line in _decode_name(zlib.decompress(
+                self._file.read(length))).splitlines():
+            boffset, blength, first = line.split(' ', 2)
+            self._blocks.append((int(boffset), int(blength)))
+            self._first.append(first)
+        self._cached = (None, None)
+
+    def __len__(self):
+        return self._count
+
+    def _block(self, idx):
+        """ Load block `idx`: (paths, digests). """
+        if self._cached[0] != idx:
+            offset, length = self._blocks[idx]
+            self._file.seek(offset)
+            data = _decode_name(zlib.decompress(self._file.read(length)))
+            paths, digests = [], []
+            for line in data.splitlines():
+                digest, path = line.split('  ', 1)
+                paths.append(path)
+                digests.append(digest)
+            self._cached = (idx, (paths, digests))
+        return self._cached[1]
+
+    def get(self, path, default=None):
+        idx = bisect.bisect_right(self._first, path) - 1
+        if idx < 0:
+            return default
+        paths, digests = self._block(idx)
+        pidx = bisect.bisect_left(paths, path)
+        if pidx < len(paths) and paths[pidx] == path:
+            return digests[pidx]
+        return default
+
+    def __contains__(self, path):
+        return self.get(path) is not None
+
+    def items(self):
+        for idx in range(len(self._blocks)):
+            paths, digests = self._block(idx)
+            for item in zip(paths, digests):
+                yield item
+
+    def __iter__(self):
+        for path, _digest in self.items():
+            yield path
+
+    def close(self):
+        self._file.close()
+
+
+def _read_file(file2check, size, update):
+    """ Pass content of `file2check` to `update` by BSIZE chunks.
+
+    Data is read into one reused buffer (or mmaped when USE_MMAP), so no
+    new objects are allocated for each chunk.
+    When FADVISE read ahead next chunk and drop processed data from page
+    cache, so reading large trees not evict cache of other applications.
+    Yield number of bytes processed so far.
+    """
+    total = 0
+    fdesc = file2check.fileno()
+    _fadvise(fdesc, 0, 0, getattr(os, 'POSIX_FADV_SEQUENTIAL', 0))
+    if USE_MMAP and not DIRECT_IO and size >= MMAP_MIN_SIZE:
+        mmapped = mmap.mmap(fdesc, 0, access=mmap.ACCESS_READ)
+        try:
+            try:
+                view = memoryview(mmapped)
+            except TypeError:  # python2 mmap not support memoryview
+                view = mmapped
+            while total < size:
+                chunk = view[total:total + BSIZE]
+                read = len(chunk)
+                if read:
+                    update(chunk)
+                del chunk
+                if not read:
+                    # file truncated after getsize
+                    break
+                _fadvise(fdesc, total, read,
+                         getattr(os, 'POSIX_FADV_DONTNEED', 0))
+                total += read
+                yield total
+            del view
+        finally:
+            mmapped.close()
+        return
+    # O_DIRECT require aligned buffer
+    buf = mmap.mmap(-1, BSIZE) if DIRECT_IO else bytearray(BSIZE)
+    try:
+        view = memoryview(buf)
+    except TypeError:  # python2 mmap
+        view = buf
+    while True:
+        read = file2check.readinto(buf)
+        if not read:
+            break
+        _fadvise(fdesc, total + read, BSIZE,
+                 getattr(os, 'POSIX_FADV_WILLNEED', 0))
+        update(view[:read])
+        _fadvise(fdesc, total, read, getattr(os, 'POSIX_FADV_DONTNEED', 0))
+        total += read
+        yield total
+
+
+def get_file_sums(filename, algorithms=ALGORITHMS, progress=True,
+                  sample=False):
+    """ Calculate digests of file for all `algorithms` in one read.
+
+    Return (filepath, {algorithm: digest}).
+    When `sample` also collect sample (see `get_file_sample`) from the same
+    read and return (filepath, {algorithm: digest}, (size, digest)).
+    """
+    hashes = [(algo, hashlib.new(algo)) for algo in algorithms]
+    if len(hashes) == 1:
+        update = hashes[0][1].update
+    else:
+        def update(data):
+            for _algo, hsh in hashes:
+                hsh.update(data)
+
+    stats = STATS
+    if stats:
+        hash_time = [0.0]
+        hash_update = update
+
+        def update(data):
+            start = _timer()
+            hash_update(data)
+            hash_time[0] += _timer() - start
+
+    start = _timer()
+    size = os.path.getsize(filename)
+    if sample:
+        sampler = _Sampler(size)
+        sums_update = update
+
+        def update(data):
+            sums_update(data)
+            sampler.update(data)
+
+    if progress:
+        print(filename, '       ', end="")
+        sys.stdout.flush()
+    last_update = time.time()
+    with _open_file(filename) as file2check:
+        for total in _read_file(file2check, size, update):
+            if progress:
+                now = time.time()
+                if now - last_update >= PROGRESS_INTERVAL:
+                    print('\b\b\b\b%3d%%' % (100 * total // max(size, 1)),
+                          end="")
+                    sys.stdout.flush()
+                    last_update = now
+    digests = dict((algo, hsh.hexdigest().lower()) for algo, hsh in hashes)
     filepath = filename.replace('\\', '/')
-    print ('\b\b\b\b\b      \r', end="")
-    return filepath, digest
+    if stats:
+        stats.add(filepath, size, _timer() - start, hash_time[0])
+    if progress:
+        print('\b\b\b\b\b      \r', end="")
+    if sample:
+        return filepath, digests, sampler.sample()
+    return filepath, digests
+
+
+def get_file_sum(filename, progress=True):
+    filepath, digests = get_file_sums(filename, ('md5', ), progress)
+    return filepath, digests['md5']
+
+
+def get_file_sample(filename):
+    """ Calculate digest of file size, head, tail and SAMPLE_POINTS blocks
+    between.
+
+    Return (size, digest).
+    """
+    md5 = hashlib.md5()
+    with io.open(filename, 'rb', buffering=0) as file2check:
+        size = os.fstat(file2check.fileno()).st_size
+        md5.update(str(size).encode('ascii'))
+        offsets, sample_size = _sample_offsets(size)
+        for offset in offsets:
+            file2check.seek(offset)
+            md5.update(file2check.read(sample_size))
+    return size, md5.hexdigest()
+
+
+def _sample_offsets(size):
+    """ Return (offsets, size) of sample blocks for file of `size`. """
+    if size <= SAMPLE_SIZE * (SAMPLE_POINTS + 2):
+        return [0], size
+    step = size // (SAMPLE_POINTS + 1)
+    offsets = [0] + [step * idx for idx in range(1, SAMPLE_POINTS + 1)]
+    offsets.append(size - SAMPLE_SIZE)
+    return offsets, SAMPLE_SIZE
+
+
+class _Sampler(object):
+    """ Collect sample blocks (see `get_file_sample`) from data passed
+    sequentially to `update`, so sample not need another read of file.
+    """
+
+    def __init__(self, size):
+        self._size = size
+        offsets, self._sample_size = _sample_offsets(size)
+        # blocks may overlap; each is collected separately
+        self._blocks = [(offset, bytearray()) for offset in offsets]
+        self._total = 0
+
+    def update(self, data):
+        start = self._total
+        self._total += len(data)
+        for offset, block in self._blocks:
+            begin = max(offset + len(block), start)
+            end = min(offset + self._sample_size, self._total)
+            if begin < end:
+                block += data[begin - start:end - start]
+
+    def sample(self):
+        """ Return (size, digest) as `get_file_sample`. """
+        md5 = hashlib.md5()
+        md5.update(str(self._size).encode('ascii'))
+        for _offset, block in self._blocks:
+            md5.update(block)
+        return self._size, md5.hexdigest()
+
+
+def _get_file_sums_safe(args, progress=False):
+    """ Worker for hash_files; return (filename, digests, sample, error).
+
+    `args` is (filename, algorithms, sample); sample is None unless
+    requested.
+    """
+    filename, algorithms, sample = args
+    try:
+        result = get_file_sums(filename, algorithms, progress, sample)
+    except (IOError, OSError) as err:
+        return filename, None, None, err
+    return filename, result[1], result[2] if sample else None, None
+
+
+def _get_head_sum_safe(filename):
+    """ Worker for find_duplicates; return (filename, digest, error). """
+    try:
+        with io.open(filename, 'rb') as file2check:
+            data = file2check.read(DUP_HEAD_SIZE)
+        return filename, hashlib.md5(data).hexdigest(), None
+    except (IOError, OSError) as err:
+        return filename, None, err
+
+
+def _get_file_sample_safe(filename):
+    """ Worker for sample_check_sums; return (filename, sample, error). """
+    try:
+        return filename, get_file_sample(filename), None
+    except (IOError, OSError) as err:
+        return filename, None, err
+
+
+def _imap(func, items, jobs):
+    """ Map `func` over `items` in thread pool; keep order of results.
+
+    Only few items are queued at once, so `items` may be long generator.
+    None items are placeholders: `func` is not called and None is yielded
+    in their place.
+    """
+    pool = ThreadPool(jobs)
+    pending = collections.deque()
+    queued = 0
+    try:
+        for item in items:
+            if item is None:
+                pending.append(None)
+            else:
+                pending.append(pool.apply_async(func, (item, )))
+                queued += 1
+            while pending and (pending[0] is None or queued >= jobs * 4 or
+                               len(pending) >= IMAP_WINDOW):
+                result = pending.popleft()
+                if result is not None:
+                    queued -= 1
+                    result = result.get()
+                yield result
+        while pending:
+            result = pending.popleft()
+            yield result if result is None else result.get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def hash_files(filenames, jobs=1, algorithms=ALGORITHMS, samples=False):
+    """ Calculate sums for `filenames`.
+
+    Yield (filename, {algorithm: digest}, error) in the same order as
+    `filenames`. When `samples` yield (filename, {algorithm: digest},
+    sample, error); sample is collected by the same read as digests.
+    None in `filenames` is placeholder for file not hashed; result with
+    all values None is yielded for it, so callers can pass all files in
+    order without keeping list of them.
+    With jobs > 1 files are hashed concurrently by thread pool (hashlib
+    release GIL when updating with large buffers).
+    When BY_DEVICE use `hash_files_by_device`.
+    """
+    if BY_DEVICE:
+        for result in hash_files_by_device(filenames, jobs, algorithms,
+                                           samples):
+            yield result
+        return
+    args = (None if filename is None else (filename, algorithms, samples)
+            for filename in filenames)
+    if jobs <= 1:
+        results = (arg and _get_file_sums_safe(arg, True) for arg in args)
+    else:
+        results = _imap(_get_file_sums_safe, args, jobs)
+    for result in results:
+        result = result or (None, None, None, None)
+        yield result if samples else result[:2] + result[3:]
+
+
+def is_rotational(dev):
+    """ Check in sysfs is block device `dev` a rotational disk. """
+    path = '/sys/dev/block/%d:%d' % (os.major(dev), os.minor(dev))
+    # partitions have no queue; check parent device
+    for qpath in (os.path.join(path, 'queue', 'rotational'),
+                  os.path.join(path, '..', 'queue', 'rotational')):
+        try:
+            with open(qpath) as qfile:
+                return qfile.read().strip() == '1'
+        except IOError:
+            continue
+    return False
+
+
+def hash_files_by_device(filenames, jobs=1, algorithms=ALGORITHMS,
+                         samples=False):
+    """ Calculate sums for `filenames` reading all devices concurrently.
+
+    Files are grouped by st_dev; each rotational device is read by one
+    reader in inode order (to limit seeking), other devices by `jobs`
+    readers.
+    Yield (filename, {algorithm: digest}, error) in the same order as
+    `filenames` (with sample before error when `samples` and placeholders
+    as in `hash_files`). Before last result print throughput for each
+    device.
+    """
+    filenames = list(filenames)
+    results = {}
+    devices = {}
+    for idx, filename in enumerate(filenames):
+        if filename is None:
+            # placeholder (see hash_files)
+            results[idx] = (None, None, None, None)
+            continue
+        try:
+            fstat = os.stat(filename)
+            dev, ino, size = fstat.st_dev, fstat.st_ino, fstat.st_size
+        except OSError:
+            dev, ino, size = None, 0, 0
+        devices.setdefault(dev, []).append((ino, idx, size))
+
+    cond = threading.Condition()
+    stop = []
+    dev_stats = {}
+
+    def worker(dev, items):
+        for _ino, idx, size in items:
+            if stop:
+                return
+            result = _get_file_sums_safe((filenames[idx], algorithms,
+                                          samples))
+            with cond:
+                results[idx] = result
+                if not result[3]:
+                    dev_stats[dev][1] += size
+                    dev_stats[dev][2] = time.time()
+                cond.notify()
+
+    start = time.time()
+    for dev, items in devices.items():
+        rotational = dev is not None and is_rotational(dev)
+        if rotational:
+            items.sort()
+        # [rotational, bytes, end time]
+        dev_stats[dev] = [rotational, 0, start]
+        readers = 1 if rotational else max(jobs, 1)
+        for num in range(readers):
+            thread = threading.Thread(target=worker,
+                                      args=(dev, items[num::readers]))
+            thread.daemon = True
+            thread.start()
+
+    try:
+        for idx in range(len(filenames)):
+            with cond:
+                while idx not in results:
+                    cond.wait(1)
+                result = results.pop(idx)
+            if idx == len(filenames) - 1:
+                # callers don't resume generator after last result
+                _show_device_stats(dev_stats, start)
+            yield result if samples else result[:2] + result[3:]
+    finally:
+        stop.append(True)
+
+
+def _show_device_stats(dev_stats, start):
+    """ Print throughput for each device and total. """
+    total_time = max(time.time() - start, 0.001)
+    total_size = 0
+    for dev in sorted(dev for dev in dev_stats if dev is not None):
+        rotational, size, end = dev_stats[dev]
+        total_size += size
+        print('Device %d:%d%s: %.1f MB, %.1f MB/s' % (
+            os.major(dev), os.minor(dev), ' (rotational)' * rotational,
+            size / 1000000.0, size / 1000000.0 / max(end - start, 0.001)))
+    print('Total: %.1f MB in %.1fs, %.1f MB/s' % (
+        total_size / 1000000.0, total_time,
+        total_size / 1000000.0 / total_time))
+
+
+def guess_algorithm(filename, digest=None):
+    """ Guess algorithm by manifest name or by digest length. """
+    basename = os.path.basename(filename)
+    if basename.endswith(INDEX_SUFFIX):
+        basename = basename[:-len(INDEX_SUFFIX)]
+    for algo, name in MANIFESTS.items():
+        if name == basename:
+            return algo
+    if digest:
+        return DIGEST_LEN_ALGORITHMS.get(len(digest))
+    return None
+
+
+def manifest_names(filename, algorithms):
+    """ Get {algorithm: manifest file name} for `algorithms`.
+
+    `filename` is used for algorithm recognised by its name or, when name is
+    not standard, for first algorithm; other manifests are created in the
+    same directory.
+    """
+    dirname = os.path.dirname(filename)
+    names = dict((algo, os.path.join(dirname,
+                                     MANIFESTS.get(algo, algo + 'sum.txt')))
+                 for algo in algorithms)
+    file_algo = guess_algorithm(filename)
+    if file_algo is None:
+        names[algorithms[0]] = filename
+    elif file_algo in names:
+        names[file_algo] = filename
+    return names
 
 
 def write_md5sum(filename, sums):
-    with open(filename, 'wb') as md5sumfile:
-        for fname, fsum in sorted(sums.iteritems()):
-            line = '%s  %s\n' % (fsum, fname)
-            md5sumfile.write(line)
+    """ Write manifest; file is replaced atomically. """
+    items = sorted(sums.items()) if isinstance(sums, dict) else sums.items()
+    tmp_filename = filename + '.tmp'
+    try:
+        with _open_text(tmp_filename, 'w') as md5sumfile:
+            for fname, fsum in items:
+                line = '%s  %s\n' % (fsum, fname)
+                md5sumfile.write(line)
+    except BaseException:
+        os.unlink(tmp_filename)
+        raise
+    os.rename(tmp_filename, filename)
+
+
+def _is_skipped(fpath, skip):
+    """ Check is `fpath` in tree one of `skip` names (see `_skip_names`).
+
+    Plain names match files in root directory, "./" paths any file.
+    """
+    return (os.path.dirname(fpath) == '.' and
+            os.path.basename(fpath) in skip or
+            fpath.replace('\\', '/') in skip)
+
+
+def _find_files(skip=(MD5SUMFILENAME, ), root='.'):
+    """ Find all files to check in `root` directory, sorted by path. """
+    try:
+        names = os.listdir(root)
+    except OSError as err:
+        print("Error", root, err, file=sys.stderr)
+        return
+    entries = []
+    for name in names:
+        fpath = os.path.join(root, name)
+        if os.path.isdir(fpath):
+            if not os.path.islink(fpath):
+                # all paths in directory start with "name/"
+                entries.append((name + '/', fpath, True))
+        elif os.path.isfile(fpath) and not _is_skipped(fpath, skip):
+            entries.append((name, fpath, False))
+    for _key, fpath, is_dir in sorted(entries):
+        if is_dir:
+            for subpath in _find_files(skip, fpath):
+                yield subpath
+        else:
+            yield fpath
+
+
+def _stat_key(fpath):
+    """ Get (size, mtime_ns, inode) used to detect changed files. """
+    fstat = os.stat(fpath)
+    mtime_ns = getattr(fstat, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(fstat.st_mtime * 1000000000)
+    return (fstat.st_size, mtime_ns, fstat.st_ino)
+
+
+def _iter_cache(filename):
+    """ Yield (path, ((size, mtime_ns, inode), digests)) from stat cache in
+    file order (sorted by path when written by write_cache). """
+    if not os.path.isfile(filename):
+        return
+    with _open_text(filename) as cachefile:
+        for line in cachefile:
+            if line.startswith('#') or len(line.strip()) == 0:
+                continue
+            try:
+                digests, size, mtime, inode, fname = line.split(' ', 4)
+                digests = dict(dig.split('=', 1) if '=' in dig
+                               else ('md5', dig)
+                               for dig in digests.split(','))
+                yield fname.rstrip('\n'), \
+                    ((int(size), int(mtime), int(inode)), digests)
+            except ValueError:
+                continue
+
+
+def load_cache(filename):
+    """ Load stat cache: {path: ((size, mtime_ns, inode), digests)}. """
+    return dict(_iter_cache(filename))
 
 
-def generate_sums(filename, update):
-    print('Generate md5sum ->', filename)
-    sums = {}
-    missing = None
+def _cache_line(fname, key, digests):
+    digests = ','.join(algo + '=' + digest
+                       for algo, digest in sorted(digests.items()))
+    return '%s %d %d %d %s\n' % ((digests, ) + key + (fname, ))
+
+
+def write_cache(filename, cache):
+    with _open_text(filename, 'w') as cachefile:
+        for fname, (key, digests) in sorted(cache.items()):
+            cachefile.write(_cache_line(fname, key, digests))
+
+
+def _iter_samples(filename):
+    """ Yield (path, (size, sample digest)) from samples file in file order
+    (sorted by path when written by write_samples). """
+    if not os.path.isfile(filename):
+        return
+    with _open_text(filename) as samplefile:
+        for line in samplefile:
+            if line.startswith('#') or len(line.strip()) == 0:
+                continue
+            try:
+                digest, size, fname = line.split(' ', 2)
+                yield fname.rstrip('\n'), (int(size), digest)
+            except ValueError:
+                continue
+
+
+def load_samples(filename):
+    """ Load samples file: {path: (size, sample digest)}. """
+    return dict(_iter_samples(filename))
+
+
+def _sample_line(fname, size, digest):
+    return '%s %d %s\n' % (digest, size, fname)
+
+
+def write_samples(filename, samples):
+    with _open_text(filename, 'w') as samplefile:
+        for fname, (size, digest) in sorted(samples.items()):
+            samplefile.write(_sample_line(fname, size, digest))
+
+
+def _skip_names(names, primary):
+    """ Get names of manifests and other own files skipped when hashing. """
+    skip = set(MANIFESTS.values())
+    skip.update(os.path.basename(name) for name in names.values())
+    for suffix in (CACHE_SUFFIX, SAMPLE_SUFFIX, TREE_SUFFIX, JOURNAL_SUFFIX):
+        skip.add(os.path.basename(names[primary] + suffix))
+    skip.update([name + INDEX_SUFFIX for name in skip])
+    skip.update([name + '.tmp' for name in skip])
+    if STATS and STATS.filename:
+        skip.add(_normalize_path(os.path.relpath(STATS.filename)))
+    return skip
+
+
+def generate_sums(filename, update, jobs=1, paranoid=False,
+                  algorithms=ALGORITHMS, tree=False):
+    """ Generate sums for files in current directory.
+
+    Sums for all `algorithms` are calculated in one pass and written to
+    manifests named by `manifest_names`.
+    When `update` use stat cache (CACHE_SUFFIX file next to first manifest)
+    to skip hashing files that not changed since last run, unless `paranoid`.
+    Samples for fast check are written to SAMPLE_SUFFIX file.
+    When `tree` write digests of directories to TREE_SUFFIX file.
+
+    Files are found in path order, so old manifests, stat cache and samples
+    (all sorted by path) are merged with them by `_Cursor`s and new files
+    are written while hashing; only old manifests are kept in memory.
+    """
+    names = manifest_names(filename, algorithms)
+    print('Generate sums ->', ', '.join(names[algo] for algo in algorithms))
+    primary = algorithms[0]
+    cache_filename = names[primary] + CACHE_SUFFIX
+    samples_filename = names[primary] + SAMPLE_SUFFIX
+    sums = dict((algo, Sums()) for algo in algorithms)
+    cache = samples = ()
     if update:
-        sums = dict(load_md5(filename))
-        missing = [fname for fname in sums.iterkeys()
-                   if not os.path.isfile(fname)]
-    for root, _dirs, files in sorted(os.walk('.')):
-        for fname in sorted(files):
-            if root == '.' and fname == 'md5sum.txt':
+        for algo in algorithms:
+            if os.path.isfile(names[algo]):
+                sums[algo] = load_sums(names[algo])
+        if not paranoid:
+            cache = _iter_cache(cache_filename)
+            samples = _iter_samples(samples_filename)
+    cache = _Cursor(cache)
+    samples = _Cursor(samples)
+    # old digests looked up when checking cache and written to new manifest
+    known = dict((algo, _Cursor(sums[algo].items())) for algo in algorithms)
+    old = dict((algo, _Cursor(sums[algo].items())) for algo in algorithms)
+    planned = collections.deque()
+
+    def plan():
+        """ Find files; yield paths to hash and None for cached files. """
+        for fpath in _find_files(_skip_names(names, primary)):
+            filepath = fpath.replace('\\', '/')
+            try:
+                key = _stat_key(fpath)
+            except OSError as err:
+                print("Error", fpath, err, file=sys.stderr)
                 continue
-            fpath = os.path.join(root, fname)
-            if not os.path.isfile(fpath):
+            cached_key, digests = cache.get(filepath) or (None, None)
+            if cached_key != key or \
+                    not set(algorithms) <= set(digests) or \
+                    any(known[algo].get(filepath) != digests[algo]
+                        for algo in algorithms):
+                digests = None
+            planned.append((fpath, filepath, key, digests,
+                            samples.get(filepath)))
+            yield None if digests else fpath
+
+    missing = {}
+    outputs = {}
+
+    def write_old(algo, path):
+        """ Write old entries before `path` (all when None) to manifest of
+        `algo`; return old digest of `path`. """
+        cursor = old[algo]
+        while cursor.path is not None and (path is None or
+                                           cursor.path < path):
+            outputs[algo].write('%s  %s\n' % (cursor.value, cursor.path))
+            if not os.path.isfile(cursor.path):
+                missing.setdefault(cursor.path, '')
+                if algo == primary:
+                    missing[cursor.path] = cursor.value
+            cursor.advance()
+        if path is None or cursor.path != path:
+            return None
+        digest = cursor.value
+        cursor.advance()
+        return digest
+
+    # new files are written to ".tmp" files and renamed at the end
+    tmpfiles = {}
+    try:
+        for fname in [names[algo] for algo in algorithms] + \
+                [cache_filename, samples_filename]:
+            tmpfiles[fname] = _open_text(fname + '.tmp', 'w')
+        for algo in algorithms:
+            outputs[algo] = tmpfiles[names[algo]]
+        cachefile = tmpfiles[cache_filename]
+        samplefile = tmpfiles[samples_filename]
+        for _fpath, digests, sample, err in hash_files(
+                plan(), jobs, algorithms, samples=True):
+            fpath, filepath, key, cached_digests, cached_sample = \
+                planned.popleft()
+            if err:
+                print("Error", fpath, err, file=sys.stderr)
                 continue
-            filepath, digest = get_file_sum(fpath)
-            current_sum = sums.get(filepath)
+            if cached_digests:
+                digests, sample = cached_digests, cached_sample
+                if not sample or sample[0] != key[0]:
+                    try:
+                        sample = get_file_sample(fpath)
+                    except (IOError, OSError) as err:
+                        print("Error", fpath, err, file=sys.stderr)
+                        continue
+            current_sum = [write_old(algo, filepath)
+                           for algo in algorithms][0]
+            for algo in algorithms:
+                outputs[algo].write('%s  %s\n' % (digests[algo], filepath))
+            digest = digests[primary]
             status = (" " if current_sum == digest else "*") \
-                     if current_sum else '+'
+                if current_sum else '+'
             print(status, digest, filepath)
-            sums[filepath] = digest
+            cachefile.write(_cache_line(filepath, key, digests))
+            samplefile.write(_sample_line(filepath, *sample))
+        for algo in algorithms:
+            write_old(algo, None)
+    except BaseException:
+        for fname, tmpfile in tmpfiles.items():
+            tmpfile.close()
+            os.unlink(fname + '.tmp')
+        raise
+    for fname, tmpfile in tmpfiles.items():
+        tmpfile.close()
+        os.rename(fname + '.tmp', fname)
     if missing:
         print(COLOR_WARNING, "Missing", COLOR_END, sep="")
-        for fname in missing:
-            print('-', sums[fname], fname, sep=" ")
-    write_md5sum(filename, sums)
+        for fname, digest in sorted(missing.items()):
+            print('-', digest, fname, sep=" ")
+    if tree:
+        dirs = dict(tree_digests(load_md5(names[primary]), primary))
+        write_md5sum(names[primary] + TREE_SUFFIX, dirs)
+        print('Root:', dirs['./'])
     exit(0)
 
 
 def load_md5(filename):
-    with open(filename) as md5sumfile:
+    with _open_text(filename) as md5sumfile:
         for line in md5sumfile:
             if line.startswith('#') or len(line.strip()) == 0:
                 continue
@@ -100,66 +1155,640 @@ def load_md5(filename):
             yield filename.strip(), md5sum.lower()
 
 
-def check_sums(filename):
-    print('Check md5sum <-', filename)
-    md5s = list(load_md5(filename))
-    files_count = len(md5s)
+def load_sums(filename):
+    """ Load manifest into Sums; skip invalid entries. """
+    sums = Sums()
+    for fname, digest in load_md5(filename):
+        try:
+            sums[fname] = digest
+        except ValueError as err:
+            print("Error", filename, fname, err, file=sys.stderr)
+    return sums
+
+
+def _tree_line(digest, name):
+    return _encode_name('%s  %s\n' % (digest, name))
+
+
+def tree_digests(items, algorithm='md5'):
+    """ Calculate digests of directories from (path, digest) `items`.
+
+    `items` must be sorted by path (as in manifest). Directory digest is
+    calculated over "digest  name" lines of its files and subdirectories
+    (with "/" appended) in path order, so digest of root ("./") change when
+    any file in tree is changed, added or removed.
+    Yield (directory path with trailing "/", digest); subdirectories before
+    parent.
+    """
+    stack = [('./', hashlib.new(algorithm))]
+    for path, digest in items:
+        if path.startswith('./'):
+            path = path[2:]
+        parts = path.split('/')
+        chain = ['./']
+        for part in parts[:-1]:
+            chain.append(chain[-1] + part + '/')
+        # close directories that are not parent of path
+        while len(stack) > len(chain) or stack[-1][0] != chain[len(stack) - 1]:
+            dirpath, hsh = stack.pop()
+            dir_digest = hsh.hexdigest()
+            yield dirpath, dir_digest
+            stack[-1][1].update(_tree_line(
+                dir_digest, dirpath[len(stack[-1][0]):]))
+        for dirpath in chain[len(stack):]:
+            stack.append((dirpath, hashlib.new(algorithm)))
+        stack[-1][1].update(_tree_line(digest, parts[-1]))
+    while stack:
+        dirpath, hsh = stack.pop()
+        dir_digest = hsh.hexdigest()
+        yield dirpath, dir_digest
+        if stack:
+            stack[-1][1].update(_tree_line(
+                dir_digest, dirpath[len(stack[-1][0]):]))
+
+
+def _manifest_algorithm(filename, sums):
+    algo = guess_algorithm(filename)
+    if not algo:
+        first = next(iter(sums.items()), (None, ''))[1]
+        algo = guess_algorithm(filename, first) or 'md5'
+    return algo
+
+
+def load_tree(filename, sums):
+    """ Load digests of directories for manifest `filename`.
+
+    Use TREE_SUFFIX file when it is not older than manifest; otherwise
+    calculate digests from `sums`.
+    """
+    tree_filename = filename + TREE_SUFFIX
+    if os.path.isfile(tree_filename) and \
+            os.path.getmtime(tree_filename) >= os.path.getmtime(filename):
+        return dict(load_md5(tree_filename))
+    return dict(tree_digests(sums.items(),
+                             _manifest_algorithm(filename, sums)))
+
+
+def compare_trees(filename, other):
+    """ Compare two manifests (i.e. of two copies of archive).
+
+    Only directories with different digests are examined.
+    """
+    print('Compare', filename, '<->', other)
+    sums, other_sums = load_sums(filename), load_sums(other)
+    tree, other_tree = load_tree(filename, sums), load_tree(other, other_sums)
+    children = {}
+    for dirpath in set(tree) | set(other_tree):
+        if dirpath != './':
+            parent = dirpath[:dirpath.rstrip('/').rindex('/') + 1]
+            children.setdefault(parent, set()).add(dirpath)
+    differences = 0
+    stack = ['./']
+    while stack:
+        dirpath = stack.pop()
+        if tree.get(dirpath) == other_tree.get(dirpath):
+            continue
+        if dirpath not in tree or dirpath not in other_tree:
+            print('-' if dirpath in tree else '+', dirpath)
+            differences += 1
+            continue
+        files = dict(sums.dir_items(dirpath))
+        other_files = dict(other_sums.dir_items(dirpath))
+        for name in sorted(set(files) | set(other_files)):
+            digest, other_digest = files.get(name), other_files.get(name)
+            if digest != other_digest:
+                status = '*' if digest and other_digest else \
+                    ('-' if digest else '+')
+                print(status, dirpath + name)
+                differences += 1
+        stack.extend(sorted(children.get(dirpath, ()), reverse=True))
+    print('Differences:', differences)
+    exit(1 if differences else 0)
+
+
+def open_manifest(filename):
+    """ Open indexed manifest or load text manifest into Sums. """
+    if filename.endswith(INDEX_SUFFIX):
+        return IndexedManifest(filename)
+    return load_sums(filename)
+
+
+def load_manifests(filename):
+    """ Load `filename` and all other known manifests from its directory.
+
+    For indexed `filename` other indexed manifests are loaded. Manifests
+    for algorithm of `filename` are skipped, so `filename` is always used.
+    Return {algorithm: Sums or IndexedManifest}.
+    """
+    dirname = os.path.dirname(filename)
+    suffix = INDEX_SUFFIX if filename.endswith(INDEX_SUFFIX) else ''
+    sums = open_manifest(filename)
+    result = {_manifest_algorithm(filename, sums): sums}
+    for algo, name in sorted(MANIFESTS.items()):
+        mfilename = os.path.join(dirname, name + suffix)
+        if algo not in result and os.path.isfile(mfilename):
+            result[algo] = open_manifest(mfilename)
+    return result
+
+
+def _normalize_path(path):
+    """ Convert path to form used in manifests ("./dir/file"). """
+    path = os.path.normpath(path).replace('\\', '/')
+    if not path.startswith('/'):
+        path = './' + path
+    return path
+
+
+def lookup(filename, paths):
+    """ Show digests of `paths` from all manifests. """
+    manifests = load_manifests(filename)
+    found = True
+    for path in paths:
+        path = _normalize_path(path)
+        digests = [(algo, sums.get(path))
+                   for algo, sums in sorted(manifests.items())]
+        digests = [(algo, digest) for algo, digest in digests if digest]
+        if not digests:
+            print(path, 'not found', file=sys.stderr)
+            found = False
+        for algo, digest in digests:
+            print(algo, digest, path)
+    exit(0 if found else 1)
+
+
+def _manifests_paths(manifests):
+    """ Yield sorted, unique paths from all `manifests`. """
+    last = None
+    for path in heapq.merge(*manifests.values()):
+        if path != last:
+            yield path
+            last = path
+
+
+def load_journal(filename):
+    """ Load results of interrupted check: {path: error or None}. """
+    done = {}
+    if not os.path.isfile(filename):
+        return done
+    with _open_text(filename) as journal:
+        for line in journal:
+            if not line.endswith('\n'):
+                # last entry not completely written
+                break
+            try:
+                status, error, fname = line[:-1].split('\t', 2)
+            except ValueError:
+                continue
+            done[fname] = error if status == 'b' else None
+    return done
+
+
+def _check_file(filename, digests, err, manifests):
+    """ Compare calculated `digests` with manifests; return error or None.
+    """
+    if err and not os.path.exists(filename):
+        return 'not found'
+    if err:
+        print("Error", filename, err, file=sys.stderr)
+        digests = {}
+    bad_algos = []
+    known = False
+    for algo, sums in sorted(manifests.items()):
+        digest = sums.get(filename)
+        if digest is not None:
+            known = True
+            if digests.get(algo) != digest:
+                bad_algos.append(algo)
+    if not known:
+        return 'not in manifest'
+    if bad_algos:
+        return 'bad checksum ' + ','.join(bad_algos)
+    return None
+
+
+def _open_journal(filename, append):
+    """ Open journal for writing; return None when it can't be written
+    (i.e. read-only media). """
+    try:
+        return _open_text(filename, 'a' if append else 'w')
+    except (IOError, OSError) as err:
+        print("Warning: can't write journal (check can't be resumed):", err,
+              file=sys.stderr)
+        return None
+
+
+def check_sums(filename, jobs=1, resume=False, paths=None,
+               journal_filename=None):
+    """ Check files by all manifests found next to `filename`.
+
+    When `paths` given check only this files.
+    Results are appended to journal file (default: JOURNAL_SUFFIX file next
+    to `filename`; skipped when not writable); when `resume` files from
+    journal are not checked again. Journal is removed after complete check.
+    """
+    print('Check sums <-', filename)
+    manifests = load_manifests(filename)
+    if paths:
+        paths = [_normalize_path(path) for path in paths]
+        files_count = len(paths)
+    else:
+        files_count = sum(1 for _path in _manifests_paths(manifests))
     if files_count == 0:
         exit(0)
+    algorithms = sorted(manifests)
+    journal_filename = journal_filename or filename + JOURNAL_SUFFIX
+    done = load_journal(journal_filename) if resume else {}
+    if done:
+        print('Resume; already checked:', len(done))
     good_files_count = 0
     bad_files_count = 0
     bad_files_names = []
-    for filename, md5sum in md5s:
-        print('[%3d/%3d' % (good_files_count + bad_files_count + 1,
-                            files_count),
-              'g:%3d' % good_files_count,
-              'b:%3d] ' % bad_files_count, end="")
-        if os.path.exists(filename):
-            digest = 0
-            try:
-                digest = get_file_sum(filename)[1]
-            except IOError, err:
-                print("Error", filename, err, file=sys.stderr)
-            if digest != md5sum:
+    if paths:
+        to_check = [fname for fname in paths if fname not in done]
+    else:
+        paths = _manifests_paths(manifests)
+        to_check = (fname for fname in _manifests_paths(manifests)
+                    if fname not in done)
+    results = hash_files(to_check, jobs, algorithms)
+    last_sync = time.time()
+    journal = _open_journal(journal_filename, resume)
+    try:
+        for filename in paths:
+            print('[%3d/%3d' % (good_files_count + bad_files_count + 1,
+                                files_count),
+                  'g:%3d' % good_files_count,
+                  'b:%3d] ' % bad_files_count, end="")
+            if filename in done:
+                error = done[filename]
+                print(filename, '(resumed)', end=' ')
+            else:
+                _fname, digests, err = next(results)
+                error = _check_file(filename, digests, err, manifests)
+                if journal:
+                    journal.write('%s\t%s\t%s\n' % (
+                        'b' if error else 'g', error or '', filename))
+                print(filename, end=' ')
+            if error:
                 bad_files_count += 1
-                bad_files_names.append((filename, 'bad checksum'))
-                print(COLOR_FAIL, '\n  bad checksum !!!!\n', COLOR_END, sep="")
+                bad_files_names.append((filename, error))
+                print(COLOR_FAIL, '\n  ', error, ' !!!!\n', COLOR_END,
+                      sep="")
             else:
                 good_files_count += 1
                 print()
-        else:
+            if journal and \
+                    time.time() - last_sync >= JOURNAL_SYNC_INTERVAL:
+                journal.flush()
+                os.fsync(journal.fileno())
+                last_sync = time.time()
+    finally:
+        if journal:
+            journal.flush()
+            os.fsync(journal.fileno())
+            journal.close()
+    if journal:
+        os.unlink(journal_filename)
+    show_errors(files_count, good_files_count, bad_files_names)
+    exit(1 if bad_files_count else 0)
+
+
+def sample_check_sums(filename, jobs=1):
+    """ Check size and samples of files (see `get_file_sample`). """
+    samples_filename = filename + SAMPLE_SUFFIX
+    print('Fast check <-', samples_filename)
+    if not os.path.isfile(samples_filename):
+        print("File", samples_filename, "not exists! Can't check",
+              file=sys.stderr)
+        exit(-1)
+    samples = sorted(load_samples(samples_filename).items())
+    files_count = len(samples)
+    if files_count == 0:
+        exit(0)
+    good_files_count = 0
+    bad_files_count = 0
+    bad_files_names = []
+    results = _imap(_get_file_sample_safe,
+                    (fname for fname, _sample in samples), max(jobs, 1))
+    for idx, (filename, sample, err) in enumerate(results):
+        size, digest = samples[idx][1]
+        print('[%3d/%3d' % (good_files_count + bad_files_count + 1,
+                            files_count),
+              'g:%3d' % good_files_count,
+              'b:%3d] ' % bad_files_count, end="")
+        error = None
+        if err:
+            error = 'not found' if not os.path.exists(filename) \
+                else 'error: %s' % err
+        elif sample[0] != size:
+            error = 'bad size'
+        elif sample[1] != digest:
+            error = 'bad sample'
+        if error:
             bad_files_count += 1
-            bad_files_names.append((filename, 'not found'))
-            print('not found !!!!!!\n')
+            bad_files_names.append((filename, error))
+            print(filename, COLOR_FAIL, ' ', error, ' !!!!', COLOR_END,
+                  sep="")
+        else:
+            good_files_count += 1
+            print(filename)
     show_errors(files_count, good_files_count, bad_files_names)
     exit(1 if bad_files_count else 0)
 
 
+def _list_dir(dirpath):
+    """ List files in `dirpath`: {name: DirEntry (or None in python2)}. """
+    try:
+        if hasattr(os, 'scandir'):
+            return dict((entry.name, entry) for entry in os.scandir(dirpath)
+                        if entry.is_file())
+        return dict((name, None) for name in os.listdir(dirpath))
+    except OSError:
+        return {}
+
+
 def quick_check_sums(filename):
+    """ Check presence of files listed in manifest.
+
+    Each directory is listed once instead of checking every file. When
+    samples (SAMPLE_SUFFIX) file exists also files size is checked.
+    """
     print('Quick check md5sum <-', filename)
-    md5s = [fsum[0] for fsum in load_md5(filename)]
-    files_count = len(md5s)
+    sums = load_sums(filename)
+    samples = load_samples(filename + SAMPLE_SUFFIX)
+    files_count = len(sums)
     if files_count == 0:
         exit(0)
     good_files_count = 0
     bad_files_count = 0
     bad_files_names = []
-    for filename in md5s:
+    # listings of current directory and its parents; manifest is sorted so
+    # other directories are not visited again
+    listings = {}
+    for filename in sums:
         print('[%3d/%3d' % (good_files_count + bad_files_count + 1,
                             files_count),
               'g:%3d' % good_files_count,
               'b:%3d] ' % bad_files_count, end="")
-        if os.path.exists(filename):
+        dirpath, name = filename.rsplit('/', 1) if '/' in filename \
+            else ('.', filename)
+        listing = listings.get(dirpath)
+        if listing is None:
+            for cached in list(listings):
+                if not dirpath.startswith(cached + '/'):
+                    del listings[cached]
+            listing = listings[dirpath] = _list_dir(dirpath)
+        error = None
+        if name not in listing:
+            error = 'not found'
+        elif filename in samples:
+            entry = listing[name]
+            try:
+                size = entry.stat().st_size if entry \
+                    else os.path.getsize(filename)
+            except OSError:
+                size = None
+            if size != samples[filename][0]:
+                error = 'bad size'
+        if error:
+            bad_files_count += 1
+            bad_files_names.append((filename, error))
+            print(filename, '', error)
+        else:
             good_files_count += 1
             print(filename)
-        else:
-            bad_files_count += 1
-            bad_files_names.append((filename, 'not found'))
-            print(filename, ' not found')
     show_errors(files_count, good_files_count, bad_files_names)
     exit(1 if bad_files_count else 0)
 
 
+def _group_by_digest(results, groups):
+    """ Add (filename, digest, error) `results` to {digest: [names]}. """
+    for fname, digest, err in results:
+        if err:
+            print("Error", fname, err, file=sys.stderr)
+            continue
+        groups.setdefault(digest, []).append(fname)
+
+
+def duplicated_sets(filenames, jobs=1):
+    """ Find duplicated files in `filenames`.
+
+    Files are grouped by size, then by digest of first DUP_HEAD_SIZE bytes;
+    only files still in groups are fully hashed.
+    Return list of (size, digest, [filenames]), bytes read and total size of
+    files.
+    """
+    by_size = {}
+    for fpath in filenames:
+        try:
+            size = os.path.getsize(fpath)
+        except OSError as err:
+            print("Error", fpath, err, file=sys.stderr)
+            continue
+        if size:
+            by_size.setdefault(size, []).append(fpath)
+    read_bytes = total_bytes = 0
+    candidates = {}
+    for size, fnames in by_size.items():
+        total_bytes += size * len(fnames)
+        if len(fnames) < 2:
+            continue
+        read_bytes += min(size, DUP_HEAD_SIZE) * len(fnames)
+        heads = {}
+        _group_by_digest(_imap(_get_head_sum_safe, fnames, max(jobs, 1)),
+                         heads)
+        for head, group in heads.items():
+            if len(group) > 1:
+                candidates[(size, head)] = group
+    del by_size
+    duplicates = []
+    for (size, head), fnames in sorted(candidates.items()):
+        if size <= DUP_HEAD_SIZE:
+            # head is whole file
+            duplicates.append((size, head, sorted(fnames)))
+            continue
+        read_bytes += size * len(fnames)
+        sums = {}
+        _group_by_digest(((fname, digests and digests['md5'], err)
+                          for fname, digests, err
+                          in hash_files(fnames, jobs, ('md5', ))), sums)
+        for digest, group in sums.items():
+            if len(group) > 1:
+                duplicates.append((size, digest, sorted(group)))
+    duplicates.sort(key=lambda dup: dup[2])
+    return duplicates, read_bytes, total_bytes
+
+
+def find_duplicates(jobs=1):
+    """ Find and show duplicated files in current directory. """
+    print('Find duplicates')
+    duplicates, read_bytes, total_bytes = \
+        duplicated_sets(_find_files(()), jobs)
+    wasted = 0
+    for size, digest, fnames in duplicates:
+        print('\n%s %d bytes' % (digest, size))
+        for fname in fnames:
+            print('   ', fname)
+        wasted += size * (len(fnames) - 1)
+    print('\nDuplicated sets:', len(duplicates), '\twasted: %d bytes' % wasted,
+          '\tread: %d of %d bytes' % (read_bytes, total_bytes))
+    exit(0)
+
+
+class Inotify(object):
+    """ Minimal inotify wrapper (by ctypes). """
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                 use_errno=True)
+        self.fd = self._libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+        # wd -> directory path
+        self.watches = {}
+
+    def add_watch(self, path, mask):
+        wdesc = self._libc.inotify_add_watch(self.fd, _encode_name(path),
+                                             mask)
+        if wdesc < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed',
+                          path)
+        self.watches[wdesc] = path
+
+    def read_events(self):
+        """ Read available events; yield (mask, path). """
+        data = os.read(self.fd, 65536)
+        offset = 0
+        while offset < len(data):
+            wdesc, mask, _cookie, length = \
+                self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = _decode_name(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & self.IN_IGNORED:
+                self.watches.pop(wdesc, None)
+                continue
+            dirpath = self.watches.get(wdesc)
+            if dirpath is None:
+                yield mask, None
+            else:
+                yield mask, (os.path.join(dirpath, name) if name
+                             else dirpath)
+
+    def close(self):
+        os.close(self.fd)
+
+
+def watch_sums(filename, jobs=1, algorithms=ALGORITHMS):
+    """ Watch current directory and update manifests when files are closed
+    after write or moved in.
+
+    Changes are collected and written after WATCH_DEBOUNCE seconds without
+    events (or WATCH_MAX_DELAY after first one). As in update mode removed
+    files are not deleted from manifests.
+    """
+    names = manifest_names(filename, algorithms)
+    primary = algorithms[0]
+    print('Watching; sums ->', ', '.join(names[algo] for algo in algorithms))
+    cache_filename = names[primary] + CACHE_SUFFIX
+    samples_filename = names[primary] + SAMPLE_SUFFIX
+    sums = dict((algo, load_sums(names[algo])
+                 if os.path.isfile(names[algo]) else Sums())
+                for algo in algorithms)
+    cache = load_cache(cache_filename)
+    samples = load_samples(samples_filename)
+    skip = _skip_names(names, primary)
+    mask = Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_TO | Inotify.IN_CREATE
+    inotify = Inotify()
+    pending = set()
+
+    def add_tree(root):
+        """ Watch all directories in `root`, add files to `pending`. """
+        for dirpath, _dirs, files in os.walk(root):
+            try:
+                inotify.add_watch(dirpath, mask)
+            except OSError as err:
+                print("Error", dirpath, err, file=sys.stderr)
+            for name in files:
+                fpath = os.path.join(dirpath, name)
+                if not _is_skipped(fpath, skip):
+                    pending.add(fpath)
+
+    def flush():
+        changed = []
+        for fpath in sorted(pending):
+            filepath = fpath.replace('\\', '/')
+            try:
+                key = _stat_key(fpath)
+            except OSError:
+                # removed before flush
+                continue
+            if cache.get(filepath, (None, ))[0] != key and \
+                    os.path.isfile(fpath):
+                changed.append((fpath, filepath, key))
+        pending.clear()
+        if not changed:
+            return
+        results = hash_files([fpath for fpath, _fp, _key in changed], jobs,
+                             algorithms, samples=True)
+        for (fpath, filepath, key), (_fpath, digests, sample, err) in \
+                zip(changed, results):
+            if err:
+                print("Error", fpath, err, file=sys.stderr)
+                continue
+            status = '*' if filepath in sums[primary] else '+'
+            print(status, digests[primary], filepath)
+            for algo in algorithms:
+                sums[algo][filepath] = digests[algo]
+            cache[filepath] = (key, digests)
+            samples[filepath] = sample
+        for algo in algorithms:
+            write_md5sum(names[algo], sums[algo])
+        write_cache(cache_filename, cache)
+        write_samples(samples_filename, samples)
+        print(time.strftime('%Y-%m-%d %H:%M:%S'), 'manifest updated')
+
+    add_tree('.')
+    first_event = last_event = time.time()
+    try:
+        while True:
+            timeout = None
+            if pending:
+                timeout = max(0, min(last_event + WATCH_DEBOUNCE,
+                                     first_event + WATCH_MAX_DELAY) -
+                              time.time())
+            ready = select.select([inotify.fd], [], [], timeout)[0]
+            if not ready:
+                flush()
+                continue
+            if not pending:
+                first_event = time.time()
+            last_event = time.time()
+            for event, path in inotify.read_events():
+                if event & Inotify.IN_Q_OVERFLOW:
+                    # events lost; check all files (by stat cache)
+                    add_tree('.')
+                elif event & Inotify.IN_ISDIR:
+                    if event & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO):
+                        add_tree(path)
+                elif event & (Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_TO):
+                    if not _is_skipped(path, skip):
+                        pending.add(path)
+    except KeyboardInterrupt:
+        flush()
+    finally:
+        inotify.close()
+
+
 def show_errors(files_cnt, good_cnt, bad_filenames):
     if bad_filenames:
         print('\n\n', COLOR_FAIL, 'Errors:', COLOR_END, sep="")
@@ -174,36 +1803,142 @@ def show_errors(files_cnt, good_cnt, bad_filenames):
 
 
 def main():
-    parser = OptionParser(usage="%prog [options] [md5sum.txt]",
+    global BSIZE, USE_MMAP, BY_DEVICE, FADVISE, DIRECT_IO, STATS
+    parser = OptionParser(usage="%prog [options] [md5sum.txt] [file ...]",
                           version="%prog " + __version__,
                           description=__doc__)
 
     parser.add_option("-c", "--check", action="store_true", dest='check',
                       default=False,
-                      help="check md5sums")
+                      help="check md5sums (optionally only given files)")
+    parser.add_option("--lookup", action="store_true", dest='lookup',
+                      default=False,
+                      help="show sums of given files from manifests")
+    parser.add_option("--to-index", action="store_true", dest='to_index',
+                      default=False,
+                      help="convert manifest to indexed format (" +
+                      INDEX_SUFFIX + ")")
+    parser.add_option("--from-index", action="store_true", dest='from_index',
+                      default=False,
+                      help="convert indexed manifest to text")
+    parser.add_option("--resume", action="store_true", dest='resume',
+                      default=False,
+                      help="continue interrupted check")
+    parser.add_option("--journal", dest='journal',
+                      help="check journal file (default: manifest name + " +
+                      JOURNAL_SUFFIX + ")")
     parser.add_option("-u", "--update", action="store_true", dest='update',
                       default=False,
                       help="update md5sums, add new files")
+    parser.add_option("--paranoid", action="store_true", dest='paranoid',
+                      default=False,
+                      help="on update ignore cache and hash all files")
     parser.add_option("-q", "--quick", action="store_true", dest='quick',
                       default=False,
-                      help="only check files presence")
+                      help="only check files presence (and size)")
+    parser.add_option("-f", "--fast", action="store_true", dest='fast',
+                      default=False,
+                      help="check only files size and samples of content")
+    parser.add_option("--block-size", type="int", dest="block_size",
+                      default=BSIZE // 1024,
+                      help="read block size in KiB (default %default)")
+    parser.add_option("--mmap", action="store_true", dest="mmap",
+                      default=False,
+                      help="use mmap for reading large files")
+    parser.add_option("-w", "--watch", action="store_true", dest="watch",
+                      default=False,
+                      help="watch directory and keep manifest up to date")
+    parser.add_option("--duplicates", action="store_true", dest="duplicates",
+                      default=False,
+                      help="find duplicated files")
+    parser.add_option("-t", "--tree", action="store_true", dest="tree",
+                      default=False,
+                      help="write digests of directories (" + TREE_SUFFIX +
+                      " file)")
+    parser.add_option("--compare", dest="compare", metavar="OTHER",
+                      help="compare manifest with OTHER manifest (i.e. of "
+                      "other copy) by directories digests")
+    parser.add_option("-a", "--algorithms", dest="algorithms",
+                      default=','.join(ALGORITHMS),
+                      help="comma separated list of algorithms used to "
+                      "generate manifests (default %default); "
+                      "known: " + ", ".join(sorted(MANIFESTS)))
+    parser.add_option("--nocache", action="store_true", dest="fadvise",
+                      default=False,
+                      help="drop read data from page cache (posix_fadvise)")
+    parser.add_option("--direct", action="store_true", dest="direct",
+                      default=False,
+                      help="read files with O_DIRECT, bypassing page cache")
+    parser.add_option("--by-device", action="store_true", dest="by_device",
+                      default=False,
+                      help="read each device by separate reader(s); "
+                      "rotational disks in inode order")
+    parser.add_option("--stats", dest="stats", metavar="FILE",
+                      help="write hashing statistics as NDJSON to FILE "
+                      "('-' for stderr)")
+    parser.add_option("-j", "--jobs", type="int", dest="jobs", default=1,
+                      help="number of files hashed concurrently (default 1); "
+                      "with --by-device - per non-rotational device")
 
     (options, args) = parser.parse_args()
+    BSIZE = max(options.block_size, 4) * 1024
+    USE_MMAP = options.mmap
+    BY_DEVICE = options.by_device
+    FADVISE = options.fadvise
+    DIRECT_IO = options.direct
+    if DIRECT_IO:
+        # O_DIRECT read size must be multiple of block size
+        BSIZE = (BSIZE + 4095) // 4096 * 4096
+    if options.stats:
+        if options.stats == '-':
+            STATS = Stats(sys.stderr)
+        else:
+            STATS = Stats(open(options.stats, 'w'), options.stats)
+        atexit.register(STATS.summary)
+    algorithms = tuple(algo.strip().lower()
+                       for algo in options.algorithms.split(',')
+                       if algo.strip())
+    for algo in algorithms or ('', ):
+        try:
+            hashlib.new(algo)
+        except ValueError:
+            parser.error("unsupported algorithm: %r" % algo)
     filename = args[0] if len(args) >= 1 else MD5SUMFILENAME
+    primary = manifest_names(filename, algorithms)[algorithms[0]]
     if options.quick:
         quick_check_sums(filename)
+    elif options.fast:
+        sample_check_sums(primary, options.jobs)
+    elif options.compare:
+        compare_trees(filename, options.compare)
+    elif options.duplicates:
+        find_duplicates(options.jobs)
+    elif options.watch:
+        watch_sums(filename, options.jobs, algorithms)
+    elif options.lookup:
+        lookup(filename, args[1:])
+    elif options.to_index:
+        write_index(filename + INDEX_SUFFIX, open_manifest(filename).items())
+    elif options.from_index:
+        if not filename.endswith(INDEX_SUFFIX):
+            parser.error("indexed manifest name should end with " +
+                         INDEX_SUFFIX)
+        write_md5sum(filename[:-len(INDEX_SUFFIX)], open_manifest(filename))
     elif options.check:
-        check_sums(filename)
+        check_sums(filename, options.jobs, options.resume, args[1:],
+                   options.journal)
     elif options.update:
-        if not os.path.isfile(filename):
-            print("File", filename, "not exists! Can't update",
+        if not os.path.isfile(primary):
+            print("File", primary, "not exists! Can't update",
                   file=sys.stderr)
             exit(-1)
-        generate_sums(filename, True)
+        generate_sums(filename, True, options.jobs, options.paranoid,
+                      algorithms, options.tree)
     else:
-        if os.path.isfile(filename):
-            raw_input('File exists! Continue (CTRL+C to break)?')
-        generate_sums(filename, options.update)
+        if os.path.isfile(primary):
+            input('File exists! Continue (CTRL+C to break)?')
+        generate_sums(filename, options.update, options.jobs,
+                      algorithms=algorithms, tree=options.tree)
 
 
 if __name__ == "__main__":
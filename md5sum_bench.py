@@ -0,0 +1,254 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Benchmark md5sum.py on synthetic file tree.
+
+Create tree of random files in temporary directory, run generate, update,
+check and quick check on it and report files/s and MB/s. Results are
+appended to results file and compared with the last run with the same
+parameters made on different md5sum.py code (identified by content hash of
+md5sum.py).
+"""
+
+from __future__ import print_function
+
+__author__ = 'Karol Będkowski'
+__copyright__ = 'Copyright (c) Karol Będkowski, 2008-2017'
+__licence__ = "GPLv2"
+__version__ = "0.1"
+
+import os
+import sys
+import json
+import hashlib
+import random
+import shutil
+import tempfile
+import time
+import platform
+import subprocess
+from optparse import OptionParser
+
+import md5sum
+
+
+_timer = getattr(time, 'perf_counter', time.time)
+
+SIZE_DISTRIBUTIONS = ('fixed', 'uniform', 'lognormal')
+
+
+def _file_sizes(count, size, distribution, rnd):
+    """ Generate `count` file sizes with mean `size`. """
+    for _idx in range(count):
+        if distribution == 'fixed':
+            yield size
+        elif distribution == 'uniform':
+            yield rnd.randint(0, 2 * size)
+        else:
+            # sigma=1 -> mean = exp(mu + 0.5)
+            yield int(rnd.lognormvariate(0, 1) * size / 1.6487)
+
+
+def create_tree(root, count, size, distribution='lognormal', depth=3,
+                fanout=4, seed=0):
+    """ Create `count` files in tree of directories `depth` levels deep.
+
+    Return total size of files.
+    """
+    rnd = random.Random(seed)
+    block = bytearray(rnd.getrandbits(8) for _idx in range(1024 * 1024))
+    dirs = ['']
+    for _level in range(depth):
+        dirs = [os.path.join(dirpath, 'd%d' % idx)
+                for dirpath in dirs for idx in range(fanout)]
+    total = 0
+    for idx, fsize in enumerate(_file_sizes(count, size, distribution, rnd)):
+        dirpath = os.path.join(root, rnd.choice(dirs))
+        if not os.path.isdir(dirpath):
+            os.makedirs(dirpath)
+        with open(os.path.join(dirpath, 'f%06d' % idx), 'wb') as ofile:
+            # unique prefix so files are not identical
+            data = ('%d\n' % idx).encode('ascii')
+            ofile.write(data[:fsize])
+            left = fsize - len(data)
+            offset = idx % len(block)
+            while left > 0:
+                chunk = block[offset:offset + left]
+                ofile.write(chunk)
+                left -= len(chunk)
+                offset = 0
+        total += fsize
+    return total
+
+
+def drop_caches():
+    """ Try to drop page cache (require root). """
+    try:
+        with open('/proc/sys/vm/drop_caches', 'w') as dcfile:
+            dcfile.write('3\n')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def _run(func, *args):
+    """ Run md5sum function quietly; return time. """
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    start = _timer()
+    try:
+        func(*args)
+    except SystemExit:
+        pass
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    return _timer() - start
+
+
+def run_benchmark(root, options):
+    """ Run all operations in `root`; return {operation: (time, bytes)}. """
+    olddir = os.getcwd()
+    os.chdir(root)
+    results = {}
+    try:
+        total = sum(os.path.getsize(os.path.join(dirpath, name))
+                    for dirpath, _dirs, files in os.walk('.')
+                    for name in files)
+        operations = [
+            ('generate', total, md5sum.generate_sums,
+             ('md5sum.txt', False, options.jobs)),
+            ('update', 0, md5sum.generate_sums,
+             ('md5sum.txt', True, options.jobs)),
+            ('check', total, md5sum.check_sums,
+             ('md5sum.txt', options.jobs)),
+            ('quick', 0, md5sum.quick_check_sums, ('md5sum.txt', )),
+        ]
+        for name, size, func, args in operations:
+            if options.drop_caches and not drop_caches():
+                print('Warning: can not drop caches', file=sys.stderr)
+            results[name] = (_run(func, *args), size)
+    finally:
+        os.chdir(olddir)
+    return results
+
+
+def load_results(filename):
+    results = []
+    if os.path.isfile(filename):
+        with open(filename) as rfile:
+            for line in rfile:
+                try:
+                    results.append(json.loads(line))
+                except ValueError:
+                    continue
+    return results
+
+
+def code_version():
+    """ Identify md5sum.py code: content hash and `git describe` if any. """
+    filename = os.path.splitext(md5sum.__file__)[0] + '.py'
+    with open(filename, 'rb') as srcfile:
+        digest = hashlib.md5(srcfile.read()).hexdigest()
+    try:
+        with open(os.devnull, 'w') as devnull:
+            describe = subprocess.check_output(
+                ['git', 'describe', '--always', '--dirty'],
+                cwd=os.path.dirname(os.path.abspath(filename)),
+                stderr=devnull)
+        describe = describe.decode('utf-8', 'replace').strip() or None
+    except (OSError, subprocess.CalledProcessError):
+        describe = None
+    return digest, describe
+
+
+def find_previous(records, params, digest):
+    """ Find last run with the same `params` on code other than `digest`. """
+    for rec in reversed(records):
+        if rec.get('params') == params and \
+                rec.get('md5sum_hash') != digest:
+            return rec
+    return None
+
+
+def _params(options):
+    return {'files': options.files, 'size': options.size,
+            'distribution': options.distribution, 'depth': options.depth,
+            'jobs': options.jobs, 'drop_caches': options.drop_caches}
+
+
+def show_results(results, files, previous=None):
+    print('%-10s %10s %12s %10s %8s' % ('operation', 'time [s]', 'files/s',
+                                         'MB/s', 'change'))
+    for name in ('generate', 'update', 'check', 'quick'):
+        elapsed, size = results[name]
+        elapsed = max(elapsed, 1e-6)
+        change = ''
+        if previous and name in previous:
+            prev = max(previous[name][0], 1e-6)
+            change = '%+.1f%%' % ((prev / elapsed - 1) * 100)
+        print('%-10s %10.3f %12.1f %10s %8s' % (
+            name, elapsed, files / elapsed,
+            '%.1f' % (size / 1000000.0 / elapsed) if size else '-', change))
+
+
+def main():
+    parser = OptionParser(usage="%prog [options]",
+                          version="%prog " + __version__,
+                          description=__doc__)
+    parser.add_option("-n", "--files", type="int", dest="files",
+                      default=1000, help="number of files (default %default)")
+    parser.add_option("-s", "--size", type="int", dest="size",
+                      default=256 * 1024,
+                      help="mean file size in bytes (default %default)")
+    parser.add_option("--distribution", dest="distribution",
+                      choices=SIZE_DISTRIBUTIONS, default='lognormal',
+                      help="size distribution: " +
+                      ", ".join(SIZE_DISTRIBUTIONS) + " (default %default)")
+    parser.add_option("--depth", type="int", dest="depth", default=3,
+                      help="directories depth (default %default)")
+    parser.add_option("-j", "--jobs", type="int", dest="jobs", default=1,
+                      help="md5sum.py --jobs (default %default)")
+    parser.add_option("--drop-caches", action="store_true",
+                      dest="drop_caches", default=False,
+                      help="drop page cache before each operation (root)")
+    parser.add_option("--dir", dest="dir",
+                      help="create tree in DIR instead of system temp dir")
+    parser.add_option("-r", "--results", dest="results",
+                      default="md5sum_bench.ndjson",
+                      help="file to store results (default %default)")
+    (options, _args) = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='md5sum_bench', dir=options.dir)
+    try:
+        print('Creating tree in', root)
+        total = create_tree(root, options.files, options.size,
+                            options.distribution, options.depth)
+        print('Files: %d, size: %.1f MB' % (options.files, total / 1000000.0))
+        results = run_benchmark(root, options)
+    finally:
+        shutil.rmtree(root)
+
+    params = _params(options)
+    digest, describe = code_version()
+    previous = find_previous(load_results(options.results), params, digest)
+    if previous:
+        print('Compared with %s from %s' % (
+            previous.get('md5sum_describe') or
+            (previous.get('md5sum_hash') or 'unknown code')[:12],
+            previous['date']))
+    show_results(results, options.files,
+                 previous['results'] if previous else None)
+    record = {'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+              'md5sum_version': md5sum.__version__,
+              'md5sum_revision': md5sum.__revision__,
+              'md5sum_hash': digest,
+              'md5sum_describe': describe,
+              'python': platform.python_version(),
+              'params': params, 'results': results}
+    with open(options.results, 'a') as rfile:
+        rfile.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,584 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import md5sum
+
+
+class _TreeTestCase(unittest.TestCase):
+    """ Run test in temporary directory with few files. """
+
+    def setUp(self):
+        self.olddir = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        os.chdir(self.tmpdir)
+        os.makedirs(os.path.join('a', 'b'))
+        self.files = {}
+        for idx in range(8):
+            fname = os.path.join('.', 'a' if idx % 2 else 'a/b',
+                                 'file%d' % idx)
+            data = os.urandom(1000 * idx + 1)
+            with open(fname, 'wb') as ofile:
+                ofile.write(data)
+            self.files[fname] = hashlib.md5(data).hexdigest()
+
+    def tearDown(self):
+        os.chdir(self.olddir)
+        shutil.rmtree(self.tmpdir)
+
+
+class TestHashFiles(_TreeTestCase):
+    def test_serial(self):
+        fnames = sorted(self.files)
+        res = list(md5sum.hash_files(fnames, 1))
+        self.assertEqual([fname for fname, _d, _e in res], fnames)
+        for fname, digest, err in res:
+            self.assertIsNone(err)
+            self.assertEqual(digest, {'md5': self.files[fname]})
+
+    def test_parallel_keep_order(self):
+        fnames = sorted(self.files) + ['./missing']
+        res = list(md5sum.hash_files(fnames, 4))
+        self.assertEqual([fname for fname, _d, _e in res], fnames)
+        for fname, digest, err in res[:-1]:
+            self.assertIsNone(err)
+            self.assertEqual(digest, {'md5': self.files[fname]})
+        self.assertIsNone(res[-1][1])
+        self.assertIsNotNone(res[-1][2])
+
+    def test_nocache_direct(self):
+        md5sum.FADVISE = md5sum.DIRECT_IO = True
+        try:
+            for fname in self.files:
+                self.assertEqual(md5sum.get_file_sum(fname, False)[1],
+                                 self.files[fname])
+        finally:
+            md5sum.FADVISE = md5sum.DIRECT_IO = False
+
+    def test_mmap_truncated(self):
+        fname = sorted(self.files)[-1]
+        size = os.path.getsize(fname)
+        orig = md5sum.USE_MMAP, md5sum.MMAP_MIN_SIZE
+        md5sum.USE_MMAP, md5sum.MMAP_MIN_SIZE = True, 0
+        try:
+            with open(fname, 'rb') as ifile:
+                # file shrunk after getsize
+                totals = list(md5sum._read_file(ifile, size + 10000,
+                                                lambda data: None))
+        finally:
+            md5sum.USE_MMAP, md5sum.MMAP_MIN_SIZE = orig
+        self.assertEqual(totals[-1], size)
+
+    def test_by_device_report(self):
+        class Output(list):
+            write = list.append
+
+            def flush(self):
+                pass
+
+        output = Output()
+        stdout = sys.stdout
+        sys.stdout = output
+        try:
+            results = md5sum.hash_files_by_device(sorted(self.files), 2)
+            # consume exactly one result per file, like generate and check
+            for _fname in self.files:
+                next(results)
+        finally:
+            sys.stdout = stdout
+        output = ''.join(output)
+        self.assertIn('Device ', output)
+        self.assertIn('Total: ', output)
+
+    def test_stats(self):
+        class Output(list):
+            write = list.append
+
+            def flush(self):
+                pass
+
+        output = Output()
+        md5sum.STATS = md5sum.Stats(output)
+        try:
+            list(md5sum.hash_files(sorted(self.files), 2))
+            md5sum.STATS.summary()
+        finally:
+            md5sum.STATS = None
+        records = [json.loads(line) for line in output]
+        self.assertEqual(len(records), len(self.files) + 1)
+        self.assertEqual(sorted(rec['file'] for rec in records[:-1]),
+                         sorted(self.files))
+        self.assertTrue(records[-1]['summary'])
+        self.assertEqual(records[-1]['bytes'],
+                         sum(rec['bytes'] for rec in records[:-1]))
+
+    def test_stats_file_skipped(self):
+        for fname in ('st.json', 'a/st.json'):
+            with open(fname, 'w') as output:
+                md5sum.STATS = md5sum.Stats(output, fname)
+                try:
+                    with self.assertRaises(SystemExit):
+                        md5sum.generate_sums('md5sum.txt', False)
+                finally:
+                    md5sum.STATS = None
+            self.assertEqual(sorted(md5sum.load_md5('md5sum.txt')),
+                             sorted(self.files.items()))
+            os.remove(fname)
+
+    def test_by_device_keep_order(self):
+        fnames = sorted(self.files) + ['./missing']
+        res = list(md5sum.hash_files_by_device(fnames, 2))
+        self.assertEqual([fname for fname, _d, _e in res], fnames)
+        for fname, digest, err in res[:-1]:
+            self.assertIsNone(err)
+            self.assertEqual(digest, {'md5': self.files[fname]})
+        self.assertIsNotNone(res[-1][2])
+
+    def test_placeholders(self):
+        fnames = sorted(self.files)
+        items = [None if idx % 3 else fname
+                 for idx, fname in enumerate(fnames)]
+        for jobs in (1, 2):
+            res = list(md5sum.hash_files(items, jobs))
+            self.assertEqual([fname for fname, _d, _e in res], items)
+            for fname, digest, err in res:
+                self.assertIsNone(err)
+                if fname:
+                    self.assertEqual(digest, {'md5': self.files[fname]})
+        res = list(md5sum.hash_files_by_device(items, 2))
+        self.assertEqual([fname for fname, _d, _e in res], items)
+
+    def test_generate_parallel(self):
+        with self.assertRaises(SystemExit):
+            md5sum.generate_sums('md5sum.txt', False, 3)
+        sums = list(md5sum.load_md5('md5sum.txt'))
+        self.assertEqual(sums, sorted(self.files.items()))
+
+
+class TestUpdateCache(_TreeTestCase):
+    def _generate(self, update, paranoid=False):
+        with self.assertRaises(SystemExit):
+            md5sum.generate_sums('md5sum.txt', update, 1, paranoid)
+        return dict(md5sum.load_md5('md5sum.txt'))
+
+    def test_update_hash_only_changed(self):
+        self._generate(False)
+        hashed = []
+        orig_get_file_sums = md5sum.get_file_sums
+
+        def get_file_sums(filename, algorithms, progress=True,
+                          sample=False):
+            hashed.append(filename)
+            return orig_get_file_sums(filename, algorithms, progress, sample)
+
+        md5sum.get_file_sums = get_file_sums
+        try:
+            with open('./a/file1', 'ab') as ofile:
+                ofile.write(b'new data')
+            sums = self._generate(True)
+            self.assertEqual(hashed, ['./a/file1'])
+            self.assertNotEqual(sums['./a/file1'], self.files['./a/file1'])
+            del hashed[:]
+            self._generate(True, True)
+            self.assertEqual(len(hashed), len(self.files))
+        finally:
+            md5sum.get_file_sums = orig_get_file_sums
+
+    def test_update_new_algorithm(self):
+        self._generate(False)
+        with self.assertRaises(SystemExit):
+            md5sum.generate_sums('md5sum.txt', True,
+                                 algorithms=('md5', 'sha256'))
+        sha256s = dict(md5sum.load_md5('sha256sum.txt'))
+        self.assertEqual(sorted(sha256s), sorted(self.files))
+        with open('./a/file1', 'rb') as ifile:
+            self.assertEqual(sha256s['./a/file1'],
+                             hashlib.sha256(ifile.read()).hexdigest())
+
+    def test_update_merge(self):
+        self._generate(False)
+        removed = self.files.pop('./a/file1')
+        os.remove('./a/file1')
+        with open('./a/b/file0', 'wb') as ofile:
+            ofile.write(b'changed')
+        self.files['./a/b/file0'] = hashlib.md5(b'changed').hexdigest()
+        with open('./a/added', 'wb') as ofile:
+            ofile.write(b'added')
+        self.files['./a/added'] = hashlib.md5(b'added').hexdigest()
+        # entry out of order in manifest
+        with open('md5sum.txt', 'a') as ofile:
+            ofile.write('%s  ./a/0\n' % ('0' * 32))
+        sums = self._generate(True)
+        # missing files are kept
+        self.assertEqual(sums.pop('./a/file1'), removed)
+        self.assertEqual(sums.pop('./a/0'), '0' * 32)
+        self.assertEqual(sums, self.files)
+        self.assertEqual(list(md5sum.load_md5('md5sum.txt')),
+                         sorted(md5sum.load_md5('md5sum.txt')))
+        self.assertEqual(sorted(md5sum.load_cache(
+            'md5sum.txt' + md5sum.CACHE_SUFFIX)), sorted(self.files))
+        self.assertEqual(sorted(os.listdir('.')),
+                         ['a', 'md5sum.txt', 'md5sum.txt.cache',
+                          'md5sum.txt.sample'])
+
+
+class TestMultiAlgorithms(_TreeTestCase):
+    def test_generate_and_check(self):
+        with self.assertRaises(SystemExit):
+            md5sum.generate_sums('md5sum.txt', False,
+                                 algorithms=('md5', 'sha256'))
+        self.assertEqual(sorted(md5sum.load_md5('md5sum.txt')),
+                         sorted(self.files.items()))
+        sha256s = dict(md5sum.load_md5('sha256sum.txt'))
+        with open('./a/file1', 'rb') as ifile:
+            self.assertEqual(sha256s['./a/file1'],
+                             hashlib.sha256(ifile.read()).hexdigest())
+
+        manifests = md5sum.load_manifests('md5sum.txt')
+        self.assertEqual(sorted(manifests), ['md5', 'sha256'])
+        self.assertEqual(dict(manifests['sha256'].items()), sha256s)
+        with self.assertRaises(SystemExit) as exc:
+            md5sum.check_sums('md5sum.txt')
+        self.assertEqual(exc.exception.code, 0)
+
+        # corrupt only sha256sum.txt
+        sha256s['./a/file1'] = '0' * 64
+        md5sum.write_md5sum('sha256sum.txt', sha256s)
+        with self.assertRaises(SystemExit) as exc:
+            md5sum.check_sums('md5sum.txt', 2)
+        self.assertEqual(exc.exception.code, 1)
+
+    def test_named_manifest_not_replaced(self):
+        with self.assertRaises(SystemExit):
+            md5sum.generate_sums('md5sum.txt', False)
+        shutil.copy('md5sum.txt', 'backup.md5')
+        with open('./a/file1', 'ab') as ofile:
+            ofile.write(b'new data')
+        with self.assertRaises(SystemExit):
+            md5sum.generate_sums('md5sum.txt', False)
+        manifests = md5sum.load_manifests('backup.md5')
+        self.assertEqual(manifests['md5']['./a/file1'],
+                         self.files['./a/file1'])
+        with self.assertRaises(SystemExit) as exc:
+            md5sum.check_sums('backup.md5')
+        self.assertEqual(exc.exception.code, 1)
+
+    def test_manifest_names(self):
+        self.assertEqual(md5sum.manifest_names('md5sum.txt', ('sha1', )),
+                         {'sha1': 'sha1sum.txt'})
+        self.assertEqual(md5sum.manifest_names('x/sums', ('sha1', 'md5')),
+                         {'sha1': 'x/sums', 'md5': 'x/md5sum.txt'})
+
+
+class TestSampleCheck(_TreeTestCase):
+    def test_sample_check(self):
+        with open('./a/big', 'wb') as ofile:
+            ofile.write(os.urandom(md5sum.SAMPLE_SIZE * 10))
+        with self.assertRaises(SystemExit):
+            md5sum.generate_sums('md5sum.txt', False)
+        samples = md5sum.load_samples('md5sum.txt' + md5sum.SAMPLE_SUFFIX)
+        self.assertEqual(len(samples), len(self.files) + 1)
+        self.assertEqual(samples['./a/big'][0], md5sum.SAMPLE_SIZE * 10)
+        with self.assertRaises(SystemExit) as exc:
+            md5sum.sample_check_sums('md5sum.txt', 2)
+        self.assertEqual(exc.exception.code, 0)
+
+        # change byte in tail
+        with open('./a/big', 'r+b') as ofile:
+            ofile.seek(-10, os.SEEK_END)
+            ofile.write(b'0123456789')
+        with self.assertRaises(SystemExit) as exc:
+            md5sum.sample_check_sums('md5sum.txt')
+        self.assertEqual(exc.exception.code, 1)
+
+    def test_sample_from_sums_read(self):
+        orig_bsize = md5sum.BSIZE
+        # chunks not aligned with sample blocks
+        md5sum.BSIZE = 10000
+        try:
+            # small, overlapping blocks, separate blocks
+            for size in (1000, md5sum.SAMPLE_SIZE * 6,
+                         md5sum.SAMPLE_SIZE * 10):
+                with open('./a/big', 'wb') as ofile:
+                    ofile.write(os.urandom(size))
+                self.assertEqual(
+                    md5sum.get_file_sums('./a/big', progress=False,
+                                         sample=True)[2],
+                    md5sum.get_file_sample('./a/big'))
+        finally:
+            md5sum.BSIZE = orig_bsize
+
+    def test_sample_truncated(self):
+        with self.assertRaises(SystemExit):
+            md5sum.generate_sums('md5sum.txt', False)
+        with open('./a/file1', 'r+b') as ofile:
+            ofile.truncate(10)
+        self.assertEqual(md5sum.get_file_sample('./a/file1')[0], 10)
+        with self.assertRaises(SystemExit) as exc:
+            md5sum.sample_check_sums('md5sum.txt')
+        self.assertEqual(exc.exception.code, 1)
+
+
+class TestTree(_TreeTestCase):
+    def test_tree_digests(self):
+        items = sorted(self.files.items())
+        dirs = dict(md5sum.tree_digests(items))
+        self.assertEqual(sorted(dirs), ['./', './a/', './a/b/'])
+        # change of file change digests of all parents
+        fname = './a/b/file0'
+        self.files[fname] = hashlib.md5(b'other').hexdigest()
+        dirs2 = dict(md5sum.tree_digests(sorted(self.files.items())))
+        for dirpath in dirs:
+            self.assertNotEqual(dirs[dirpath], dirs2[dirpath])
+
+    def test_compare(self):
+        with self.assertRaises(SystemExit):
+            md5sum.generate_sums('md5sum.txt', False, tree=True)
+        self.assertTrue(os.path.isfile('md5sum.txt' + md5sum.TREE_SUFFIX))
+        sums = dict(md5sum.load_md5('md5sum.txt'))
+        with self.assertRaises(SystemExit) as exc:
+            md5sum.compare_trees('md5sum.txt', 'md5sum.txt')
+        self.assertEqual(exc.exception.code, 0)
+        sums['./a/file1'] = hashlib.md5(b'other').hexdigest()
+        sums['./a/c/new'] = hashlib.md5(b'new').hexdigest()
+        md5sum.write_md5sum('other.txt', sums)
+        dirs = dict(md5sum.tree_digests(md5sum.load_sums('other.txt').items()))
+        self.assertEqual(sorted(dirs), ['./', './a/', './a/b/', './a/c/'])
+        with self.assertRaises(SystemExit) as exc:
+            md5sum.compare_trees('md5sum.txt', 'other.txt')
+        self.assertEqual(exc.exception.code, 1)
+
+
+class _CheckTestCase(_TreeTestCase):
+    """ Tree test case with `_check` returning summary of check_sums. """
+
+    def _check(self, resume, journal=None):
+        summary = []
+        orig_show_errors = md5sum.show_errors
+        md5sum.show_errors = lambda *args: summary.append(args)
+        try:
+            with self.assertRaises(SystemExit):
+                md5sum.check_sums('md5sum.txt', 1, resume, None, journal)
+        finally:
+            md5sum.show_errors = orig_show_errors
+        return summary[0]
+
+
+class TestResume(_CheckTestCase):
+    def test_resume(self):
+        with self.assertRaises(SystemExit):
+            md5sum.generate_sums('md5sum.txt', False)
+        os.unlink('./a/file3')
+        with open('./a/b/file4', 'ab') as ofile:
+            ofile.write(b'x')
+        expected = self._check(False)
+        self.assertFalse(os.path.exists('md5sum.txt' +
+                                        md5sum.JOURNAL_SUFFIX))
+
+        hashed = []
+        orig_get_file_sums = md5sum.get_file_sums
+
+        def get_file_sums(filename, algorithms, progress=True,
+                          sample=False):
+            if len(hashed) == 5:
+                raise KeyboardInterrupt()
+            hashed.append(filename)
+            return orig_get_file_sums(filename, algorithms, progress, sample)
+
+        md5sum.get_file_sums = get_file_sums
+        try:
+            with self.assertRaises(KeyboardInterrupt):
+                md5sum.check_sums('md5sum.txt')
+            journal = md5sum.load_journal('md5sum.txt' +
+                                          md5sum.JOURNAL_SUFFIX)
+            self.assertEqual(len(journal), 5)
+            del hashed[:]
+            self.assertEqual(self._check(True), expected)
+            self.assertEqual(len(hashed), len(self.files) - 5)
+        finally:
+            md5sum.get_file_sums = orig_get_file_sums
+
+    def test_journal_not_writable(self):
+        with self.assertRaises(SystemExit):
+            md5sum.generate_sums('md5sum.txt', False)
+        # i.e. read-only media
+        journal = os.path.join(self.tmpdir, 'missing', 'journal')
+        files_count, good_count, bad_files = self._check(False, journal)
+        self.assertEqual((files_count, good_count, bad_files),
+                         (len(self.files), len(self.files), []))
+        self.assertFalse(os.path.exists(journal))
+
+
+class TestNames(_CheckTestCase):
+    def test_not_utf8_name(self):
+        data = os.urandom(100)
+        with open(b'./a/bad\xffname', 'wb') as ofile:
+            ofile.write(data)
+        with self.assertRaises(SystemExit):
+            md5sum.generate_sums('md5sum.txt', False)
+        self.assertFalse(os.path.exists('md5sum.txt.tmp'))
+        sums = dict((md5sum._encode_name(name), digest) for name, digest
+                    in md5sum.load_md5('md5sum.txt'))
+        self.assertEqual(sums[b'./a/bad\xffname'],
+                         hashlib.md5(data).hexdigest())
+        files_count, good_count, bad_files = self._check(False)
+        self.assertEqual((files_count, good_count, bad_files),
+                         (len(self.files) + 1, len(self.files) + 1, []))
+        # update use cache file
+        with self.assertRaises(SystemExit):
+            md5sum.generate_sums('md5sum.txt', True)
+
+
+class TestDuplicates(_TreeTestCase):
+    def test_find_duplicates(self):
+        data = os.urandom(md5sum.DUP_HEAD_SIZE * 2)
+        for fname in ('./a/big1', './a/b/big2', './a/big3'):
+            with open(fname, 'wb') as ofile:
+                ofile.write(data)
+        # same size and head, different tail
+        with open('./a/big4', 'wb') as ofile:
+            ofile.write(data[:-1] + b'x')
+        shutil.copy('./a/file1', './a/file1.copy')
+        dups, _read, _total = md5sum.duplicated_sets(md5sum._find_files(), 2)
+        fnames = [fnames for _size, _digest, fnames in dups]
+        self.assertEqual(fnames, [['./a/b/big2', './a/big1', './a/big3'],
+                                  ['./a/file1', './a/file1.copy']])
+
+
+class TestQuickCheck(_TreeTestCase):
+    def test_quick_check(self):
+        with self.assertRaises(SystemExit):
+            md5sum.generate_sums('md5sum.txt', False)
+        with self.assertRaises(SystemExit) as exc:
+            md5sum.quick_check_sums('md5sum.txt')
+        self.assertEqual(exc.exception.code, 0)
+        bad = []
+        orig_show_errors = md5sum.show_errors
+        md5sum.show_errors = lambda cnt, good, bad_files: bad.extend(
+            bad_files)
+        try:
+            os.unlink('./a/file3')
+            with open('./a/b/file2', 'ab') as ofile:
+                ofile.write(b'x')
+            with self.assertRaises(SystemExit) as exc:
+                md5sum.quick_check_sums('md5sum.txt')
+            self.assertEqual(exc.exception.code, 1)
+        finally:
+            md5sum.show_errors = orig_show_errors
+        self.assertEqual(bad, [('./a/b/file2', 'bad size'),
+                               ('./a/file3', 'not found')])
+
+
+class TestIndex(_TreeTestCase):
+    def test_index(self):
+        items = sorted(('./d%03d/f%04d' % (idx // 100, idx),
+                        hashlib.md5(str(idx).encode()).hexdigest())
+                       for idx in range(3000))
+        md5sum.write_index('md5sum.txt.idx', items)
+        idx = md5sum.IndexedManifest('md5sum.txt.idx')
+        try:
+            self.assertEqual(len(idx), 3000)
+            self.assertEqual(list(idx.items()), items)
+            for path, digest in items[::97] + items[-1:]:
+                self.assertEqual(idx.get(path), digest)
+            self.assertIsNone(idx.get('./d000/f'))
+            self.assertIsNone(idx.get('./'))
+            self.assertIsNone(idx.get('./e'))
+        finally:
+            idx.close()
+
+    def test_check_paths(self):
+        with self.assertRaises(SystemExit):
+            md5sum.generate_sums('md5sum.txt', False)
+        md5sum.write_index('md5sum.txt.idx',
+                           md5sum.open_manifest('md5sum.txt').items())
+        with open('./a/file1', 'ab') as ofile:
+            ofile.write(b'x')
+        for manifest in ('md5sum.txt', 'md5sum.txt.idx'):
+            with self.assertRaises(SystemExit) as exc:
+                md5sum.check_sums(manifest, paths=['a/file3', 'a/b/file0'])
+            self.assertEqual(exc.exception.code, 0)
+            with self.assertRaises(SystemExit) as exc:
+                md5sum.check_sums(manifest, paths=['a/file1'])
+            self.assertEqual(exc.exception.code, 1)
+            with self.assertRaises(SystemExit) as exc:
+                md5sum.check_sums(manifest, paths=['a/other'])
+            self.assertEqual(exc.exception.code, 1)
+
+
+class TestInotify(_TreeTestCase):
+    def test_events(self):
+        inotify = md5sum.Inotify()
+        try:
+            inotify.add_watch('./a', md5sum.Inotify.IN_CLOSE_WRITE)
+            with open('./a/new', 'wb') as ofile:
+                ofile.write(b'data')
+            events = list(inotify.read_events())
+        finally:
+            inotify.close()
+        self.assertEqual(events, [(md5sum.Inotify.IN_CLOSE_WRITE,
+                                   './a/new')])
+
+
+class TestSums(unittest.TestCase):
+    def test_sums(self):
+        digest = hashlib.md5(b'').hexdigest()
+        sums = md5sum.Sums()
+        paths = ['./a/b/c', './a/b-c', './a/b/a', 'x', './a/b/c']
+        for idx, path in enumerate(paths):
+            sums[path] = digest[idx:] + digest[:idx]
+        self.assertEqual(len(sums), 4)
+        self.assertEqual(list(sums), sorted(set(paths)))
+        self.assertEqual(sums['./a/b/c'], digest[4:] + digest[:4])
+        self.assertEqual(sums.get('./a/b-c'), digest[1:] + digest[:1])
+        self.assertEqual(sums.get('x'), digest[3:] + digest[:3])
+        self.assertIsNone(sums.get('./a'))
+        self.assertNotIn('./a/b', sums)
+        with self.assertRaises(ValueError):
+            sums['y'] = 'abc'
+        self.assertEqual([name for name, _d in sums.dir_items('./a/')],
+                         ['b-c'])
+        self.assertEqual([name for name, _d in sums.dir_items('./a/b/')],
+                         ['a', 'c'])
+
+    def test_sorted_input(self):
+        digest = hashlib.md5(b'').hexdigest()
+        other = hashlib.md5(b'x').hexdigest()
+        sums = md5sum.Sums()
+        paths = ['./a/%04d' % idx for idx in range(100)]
+        for path in paths:
+            sums[path] = digest
+        sums[paths[-1]] = other
+        sums[paths[10]] = other
+        self.assertEqual(len(sums), 100)
+        self.assertEqual(list(sums), paths)
+        self.assertEqual(sums[paths[-1]], other)
+        self.assertEqual(sums[paths[10]], other)
+        self.assertEqual(sums[paths[50]], digest)
+
+    def test_find_files_sorted(self):
+        tmpdir = tempfile.mkdtemp()
+        olddir = os.getcwd()
+        try:
+            os.chdir(tmpdir)
+            for path in ('a/b/c', 'a/b-c/d', 'a/b.c', 'a/b0', 'a/c'):
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                open(path, 'w').close()
+            files = list(md5sum._find_files())
+            self.assertEqual(len(files), 5)
+            self.assertEqual(files, sorted(files))
+        finally:
+            os.chdir(olddir)
+            shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    unittest.main()